@@ -2,14 +2,10 @@
 import os
 import json
 from dotenv import load_dotenv
-import together
 
 # load dotenv from environment
 load_dotenv()
 
-# loads the api key
-together.api_key = os.getenv('TOGETHER_AI_API_KEY')
-
 
 # Load the JSON data from a file
 def load_json():
@@ -49,6 +45,10 @@ def get_markdown_description(description):
         text: {description}
     """
 
+    # together is imported on the first overview, not with the login page
+    import together
+    together.api_key = os.getenv('TOGETHER_AI_API_KEY')
+
     # generate response
     output = together.Complete.create(
         prompt=prompt_1,
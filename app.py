@@ -5,7 +5,7 @@ import ai as aipy
 import pandas as pd  # temporary
 # from cvr_analysis import CvrBusiness
 from cvr_analysis_1 import CvrBusiness
-from cvr_analysis_1 import cols_to_drop
+from cvr_analysis_1 import cluster_features
 
 st.set_page_config(
     page_title="Benchmark App",
@@ -71,6 +71,10 @@ def insert_user(username, hashed_password):
         conn.close()
     return result
 
+# Prepares the data, KPI tables and clusterings in the background while
+# users log in, started once per server process
+CvrBusiness.start_warmup()
+
 ####################### APP LAYOUT ##################################
 
 
@@ -83,15 +87,21 @@ def main_app():
 
     cvr_business = CvrBusiness()
 
-    @st.cache_data
-    def load_data():
-        data = cvr_business.merge_tables()  # remember to adjust
+    # Only the frame of the current version is kept, older ones are freed
+    @st.cache_resource(max_entries=1)
+    def load_data(data_version):
+        # One frame shared by every session and rerun without copying, so it
+        # is read only: CvrBusiness methods never change their input.
+        # cols_to_drop are left out when reading the database, data_version
+        # reloads the data after a delta is applied. It is the frame the
+        # warmup read, or waits for it while the warmup is running
+        data = cvr_business.merge_tables(profile='dashboard')
         # data['cvr'] = data['cvr'].astype(str)  # temporary
         return data
 
-    # LOADS DATA
-    data = load_data()
-    data = data.drop(columns=cols_to_drop, axis=1)  # updated change
+    # LOADS DATA (downloading the database first, its version names the data)
+    cvr_business.check_file_exists()
+    data = load_data(cvr_business.data_version())
 
     _, colB, _ = st.columns(3, gap='small')
     with colB:
@@ -104,6 +114,7 @@ def main_app():
         st.title('👤 User Inputs')
         cvr_num1 = st.text_input('Enter CVR 1', help='eg 25862716')
         cvr_num2 = st.text_input('Enter CVR 2', help='eg 10036127')
+        other_cvrs = st.text_input('Other CVRs', help='comma separated, eg 10000025, 10000068')
         # year_emp = st.text_input('Enter Year', help='Works with Employee plot')
 
         st.title('🔍 Filters')
@@ -111,10 +122,14 @@ def main_app():
         # select_cluster = st.selectbox('Perform Cluster Analysis', ['', 'cluster'])
         # select_cluster = st.button('Perform Cluster Analysis')
         select_cluster = st.checkbox('Perform Cluster Analysis')
+        cluster_on = st.selectbox('Cluster On', ['profit_loss', 'financial ratios'],
+                                  help='financial ratios uses revenue, ROA, current ratio and solvency ratio')
+        use_best_k = st.checkbox('Use Best No of Clusters',
+                                 help='Picks the number of clusters with the highest silhouette score')
         cluster_no = st.text_input('Enter Cluster No')
 
         # Select a filter for merged data -- uses analyze business
-        filters = ['low_debt', 'declining', 'profitable']
+        filters = list(CvrBusiness.filters)
         select_filter = st.multiselect('Add Filter', filters)
 
         # Select metric to use
@@ -123,6 +138,11 @@ def main_app():
         select_metric = st.selectbox(
             'Select Business Metric', metrics_to_analyze, help='This is used with compare company metric')
 
+        # Select how charts are drawn
+        cvr_business.renderer = st.selectbox(
+            'Chart Style', list(CvrBusiness.renderers),
+            help='plotly charts are interactive, matplotlib charts are images')
+
         # Select Plots to show
         st.subheader('Trend Analysis 📈')
         plot_1 = st.selectbox(
@@ -143,6 +163,9 @@ def main_app():
         st.subheader('Benchmarking  Analysis 📊🏋🏾‍♂️')
         plot_5 = st.selectbox(
             'Select Plot 5', ['', 'compare total employee count'])
+        select_peers = st.selectbox(
+            'Benchmark CVR 1 against', ['', 'entered CVRs', 'filtered companies', 'cluster'],
+            help='Median, quartiles and percentile rank of the peer group')
 
         ############################# ai ##############################
         json_data = aipy.load_json()
@@ -175,7 +198,7 @@ def main_app():
     ####################  Exit Slider  #############################
 
     # Get cvr
-    cvr_list = [cvr_num1, cvr_num2]
+    cvr_list = [cvr.strip() for cvr in [cvr_num1, cvr_num2, *other_cvrs.split(',')] if cvr.strip()]
     try:
         cluster_no = int(cluster_no)
     except ValueError as e:
@@ -202,103 +225,91 @@ def main_app():
     # Cluster analysis
     if select_cluster:
         # clut_no, clusters, vec_data = cvr_business.cluster_companies()
-        fig_0 = cvr_business.plot_clusters()
+        cluster_metric = cluster_features if cluster_on == 'financial ratios' else cluster_on
+        # diagnostics are cached, so the best k is only searched once
+        num_clusters = cvr_business.best_k(cluster_metric) if use_best_k else 10
+        fig_0 = cvr_business.cluster_png(cluster_metric, num_clusters)
         if cluster_no:
-            clu = cvr_business.filter_cluster_companies(int(cluster_no))
+            clu = cvr_business.filter_cluster_companies(
+                int(cluster_no), cluster_metric, num_clusters)
             fig_00 = pd.DataFrame(clu, columns=['cvr'])
             fig_00['cvr'] = fig_00['cvr'].astype(str)
         else:
-            clu = cvr_business.filter_cluster_companies()
+            clu = cvr_business.filter_cluster_companies(0, cluster_metric, num_clusters)
             fig_00 = pd.DataFrame(clu, columns=['cvr'])
             fig_00['cvr'] = fig_00['cvr'].astype(str)
 
         st.session_state['is_plotted'] = True
 
+    # Charts are drawn from the filtered data when a filter is selected.
+    # They are cached per plot, cvrs, filters and metric, so a rerun only
+    # redraws the charts whose inputs changed
+    if st.session_state['filter_selected']:
+        plot_data, plot_filters = filtered_d, select_filter
+    else:
+        plot_data, plot_filters = data, []
+
     # Trend Analysis
     if plot_1:
         if 'compare companies profit' in plot_1:
-            if st.session_state['filter_selected']:
-                fig_1 = cvr_business.compare_companies_profit(
-                    cvr_list, filtered_d)
-            else:
-                fig_1 = cvr_business.compare_companies_profit(cvr_list, data)
+            fig_1 = cvr_business.chart('compare_companies_profit', plot_data, cvr_list,
+                                       filters=plot_filters)
         else:
-            if st.session_state['filter_selected']:
-                if st.session_state['metric_selected']:
-                    fig_1 = cvr_business.compare_company_metric(
-                        filtered_d, cvr_list, selected_metric)
-                else:
-                    fig_1 = cvr_business.compare_company_metric(data, cvr_list)
-            else:
-                if st.session_state['metric_selected']:
-                    fig_1 = cvr_business.compare_company_metric(
-                        data, cvr_list, selected_metric)
-                else:
-                    fig_1 = cvr_business.compare_company_metric(data, cvr_list)
+            # selected_metric is only set when a metric was selected
+            metric = selected_metric if st.session_state['metric_selected'] else None
+            fig_1 = cvr_business.chart('compare_company_metric', plot_data, cvr_list,
+                                       metric, plot_filters)
         st.session_state['is_plotted'] = True
 
     ######### Comparative Analysis ⚖️ #################
     if plot_2:
         if 'compare roa' in plot_2:
-            if st.session_state['filter_selected']:
-                fig_2 = cvr_business.compare_roa(filtered_d, cvr_list)
-            else:
-                fig_2 = cvr_business.compare_roa(data, cvr_list)
+            fig_2 = cvr_business.chart('compare_roa', plot_data, cvr_list,
+                                       filters=plot_filters)
         st.session_state['is_plotted'] = True
 
     ######### Financial Health Indicators 💊 #################
+    plots_3 = {
+        'compare current ratio (single plot)': 'compare_current_ratio_single_plot',
+        'compare current ratio': 'compare_current_ratio',
+        'compare solvency ratio side_by_side': 'compare_solvency_ratio_side_by_side',
+        'compare solvency ratio combined': 'compare_solvency_ratio_combined',
+    }
     if plot_3:
-        if 'compare current ratio (single plot)' in plot_3:
-            if st.session_state['filter_selected']:
-                fig_3 = cvr_business.compare_current_ratio_single_plot(
-                    filtered_d, cvr_list)
-            else:
-                fig_3 = cvr_business.compare_current_ratio_single_plot(
-                    data, cvr_list)
-        elif 'compare current ratio' in plot_3:
-            if st.session_state['filter_selected']:
-                fig_3 = cvr_business.compare_current_ratio(
-                    filtered_d, cvr_list)
-            else:
-                fig_3 = cvr_business.compare_current_ratio(data, cvr_list)
-        elif 'compare solvency ratio side_by_side' in plot_3:
-            if st.session_state['filter_selected']:
-                fig_3 = cvr_business.compare_solvency_ratio_side_by_side(
-                    filtered_d, cvr_list)
-            else:
-                fig_3 = cvr_business.compare_solvency_ratio_side_by_side(
-                    data, cvr_list)
-        elif 'compare solvency ratio combined' in plot_3:
-            if st.session_state['filter_selected']:
-                fig_3 = cvr_business.compare_solvency_ratio_combined(
-                    filtered_d, cvr_list)
-            else:
-                fig_3 = cvr_business.compare_solvency_ratio_combined(
-                    data, cvr_list)
+        fig_3 = cvr_business.chart(plots_3[plot_3], plot_data, cvr_list,
+                                   filters=plot_filters)
         st.session_state['is_plotted'] = True
 
     ######### Correlation  Analysis 📈📉#################
     if plot_4:
         if 'compare revenue profit_loss' in plot_4:
-            if st.session_state['filter_selected']:
-                fig_4 = cvr_business.compare_revenue_profit_loss(
-                    filtered_d, cvr_list)
-            else:
-                fig_4 = cvr_business.compare_revenue_profit_loss(
-                    data, cvr_list)
+            fig_4 = cvr_business.chart('compare_revenue_profit_loss', plot_data, cvr_list,
+                                       filters=plot_filters)
         st.session_state['is_plotted'] = True
 
     ######### Benchmarking  Analysis 📊🏋🏾‍♂️ #################
     if plot_5:
         if 'compare total employee count' in plot_5:  # compare revenue profit_loss'
-            if st.session_state['filter_selected']:
-                fig_5 = cvr_business.compare_total_employee_count(
-                    filtered_d, cvr_list)
-            else:
-                fig_5 = cvr_business.compare_total_employee_count(
-                    data, cvr_list)
+            fig_5 = cvr_business.chart('compare_total_employee_count', plot_data, cvr_list,
+                                       filters=plot_filters)
         st.session_state['is_plotted'] = True
 
+    ######### Peer Benchmark, CVR 1 against a peer group #################
+    if select_peers and cvr_list:
+        if select_peers == 'entered CVRs':
+            peers = cvr_list
+        elif select_peers == 'filtered companies' and st.session_state['filter_selected']:
+            peers = [cvr_list[0], *[str(cvr) for cvr in cvrs_filtered]]
+        elif select_peers == 'cluster' and select_cluster:
+            peers = [cvr_list[0], *fig_00['cvr']]
+        else:
+            peers = []
+        if peers:
+            metric = selected_metric if st.session_state['metric_selected'] else None
+            fig_6 = cvr_business.chart('compare_peers', plot_data, list(dict.fromkeys(peers)), metric,
+                                       plot_filters)
+            st.session_state['is_plotted'] = True
+
     # COLUMNS TO SPLIT THE PAGE
     a_0 = st.columns((0.5, 2, 0.5), gap='small')
     a = st.columns((0.5, 2, 0.5), gap='small')
@@ -307,37 +318,55 @@ def main_app():
     d = st.columns((0.5, 2, 0.5), gap='small')
     e = st.columns((0.5, 2, 0.5), gap='small')
     f = st.columns((0.5, 2, 0.5), gap='small')
+    g = st.columns((0.5, 2, 0.5), gap='small')
     ########## USING COLUMN TO PLOT CHARTS ####################
+    def show_chart(column, chart):
+        # matplotlib charts are PNG bytes, plotly charts are figures and
+        # anything else is a message (eg wrong cvrs)
+        if isinstance(chart, bytes):
+            column.image(chart, use_column_width=True)
+        elif hasattr(chart, 'to_plotly_json'):
+            column.plotly_chart(chart, use_container_width=True)
+        else:
+            column.write(chart)
+
+    # filtered data is a subset of data, so one indexed lookup is enough
+    cvrs_found = cvr_business.has_companies(data, cvr_list)
     try:
-        a_0[1].pyplot(fig_0)
+        show_chart(a_0[1], fig_0)
         a_0[2].write(fig_00)
     except Exception as e:
         pass
 
     try:
-        if any(data['cvr'].isin(cvr_list)) or any(filtered_d['cvr'].isin(cvr_list)):
-            a[1].pyplot(fig_1)
+        if cvrs_found:
+            show_chart(a[1], fig_1)
     except Exception as e:
         pass
     try:
-        if any(data['cvr'].isin(cvr_list)) or any(filtered_d['cvr'].isin(cvr_list)):
-            b[1].pyplot(fig_2)
+        if cvrs_found:
+            show_chart(b[1], fig_2)
     except Exception as e:
         pass
     try:
-        if any(data['cvr'].isin(cvr_list)) or any(filtered_d['cvr'].isin(cvr_list)):
-            c[1].pyplot(fig_3)
+        if cvrs_found:
+            show_chart(c[1], fig_3)
     except Exception as e:
         pass
     
     try:
-        if any(data['cvr'].isin(cvr_list)) or any(filtered_d['cvr'].isin(cvr_list)):
-            d[1].pyplot(fig_4)
+        if cvrs_found:
+            show_chart(d[1], fig_4)
     except Exception as e:
         pass
     try:
-        if any(data['cvr'].isin(cvr_list)) or any(filtered_d['cvr'].isin(cvr_list)):
-            e[1].pyplot(fig_5)
+        if cvrs_found:
+            show_chart(e[1], fig_5)
+    except Exception as e:
+        pass
+    try:
+        if cvrs_found:
+            show_chart(g[1], fig_6)
     except Exception as e:
         pass
 
@@ -384,6 +413,15 @@ def login_form():
                 else:
                     st.error("😕 User not known or password incorrect")
 
+        # Readiness of the data prepared by the background warmup
+        warmup_state = CvrBusiness.warmup_state()
+        if warmup_state == 'ready':
+            st.caption('✅ Data is ready.')
+        elif warmup_state == 'running':
+            st.caption('⏳ Preparing data, the first page may take a moment.')
+        elif warmup_state == 'failed':
+            st.caption('⚠️ Data could not be prepared in advance, it will load on first use.')
+
 
 # Function to create the sign up form
 def sign_up_form():
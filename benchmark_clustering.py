@@ -0,0 +1,37 @@
+# Compares wall time and inertia of the clustering engines
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from cvr_analysis_1 import CvrBusiness
+
+parser = argparse.ArgumentParser(description='Benchmark clustering engines')
+parser.add_argument('--db', default='cvr.db', help='path to cvr database')
+parser.add_argument('--metric', default='profit_loss')
+parser.add_argument('--clusters', type=int, default=10)
+parser.add_argument('--batch-size', type=int, default=1024)
+parser.add_argument('--scale', type=int, default=1,
+                    help='repeat the companies (with noise) to simulate a larger register')
+args = parser.parse_args()
+
+cv = CvrBusiness(args.db)
+vectors = cv.cluster_vectors(args.metric).to_numpy()
+
+# Larger populations are made by jittering copies of the real vectors
+if args.scale > 1:
+    rng = np.random.default_rng(0)
+    vectors = np.concatenate(
+        [vectors] + [vectors + rng.normal(0, 0.01, vectors.shape).astype(np.float32)
+                     for _ in range(args.scale - 1)])
+
+results = []
+for engine in ['kmeans', 'minibatch']:
+    start = time.perf_counter()
+    model = cv.fit_cluster_model(vectors, args.clusters, engine, args.batch_size)
+    seconds = time.perf_counter() - start
+    results.append({'engine': engine, 'companies': len(vectors),
+                    'seconds': round(seconds, 3), 'inertia': model.inertia_})
+
+results = pd.DataFrame(results)
+results['inertia_vs_kmeans'] = results['inertia'] / results['inertia'].iloc[0]
+print(results.to_string(index=False))
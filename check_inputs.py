@@ -0,0 +1,32 @@
+# Runs the analysis methods in check mode, failing if any of them writes
+# into the shared merged frame
+import argparse
+from cvr_analysis_1 import CvrBusiness
+
+parser = argparse.ArgumentParser(description='Check analysis methods leave their input untouched')
+parser.add_argument('--db', default='cvr.db', help='path to cvr database')
+parser.add_argument('--cvrs', nargs='+', help='companies to compare, defaults to the first two')
+args = parser.parse_args()
+
+CvrBusiness.check_inputs = True
+cv = CvrBusiness(args.db)
+data = cv.merge_tables(profile='dashboard')
+cvrs = args.cvrs or [str(cvr) for cvr in data['cvr'].unique()[:2]]
+
+cv.analyze_companies(data, list(CvrBusiness.filters))
+cv.find_profitable_companies(data)
+cv.find_declining_companies(data)
+cv.find_low_debt_companies(data)
+cv.apply_filter(cvrs, data)
+cv.peer_stats(data, cvrs)
+cv.chart('compare_companies_profit', data, cvrs)
+cv.chart('compare_company_metric', data, cvrs, 'revenue')
+for method in ['compare_roa', 'compare_current_ratio_single_plot', 'compare_current_ratio',
+               'compare_solvency_ratio_side_by_side', 'compare_solvency_ratio_combined',
+               'compare_revenue_profit_loss', 'compare_total_employee_count', 'compare_peers']:
+    for renderer in CvrBusiness.renderers:
+        cv.render(getattr(cv, method)(data, cvrs), renderer)
+cv.missing_data(data)
+cv.unique_values(data)
+
+print(f'No method changed its input ({len(data)} rows, cvrs {cvrs})')
@@ -1,47 +1,244 @@
 # IMPORT LIBRARIES
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
-import gdown
+# gdown, joblib, scikit-learn, matplotlib and seaborn are imported by the
+# methods that use them, so importing this module (and the login page) stays fast
 import sqlite3
 import pandas as pd
 import numpy as np
+import hashlib
+import json
 import os
-from sklearn.preprocessing import MinMaxScaler
-from sklearn.cluster import KMeans
-import matplotlib.pyplot as plt
-import seaborn as sns
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from functools import lru_cache, partial, wraps
+from glob import glob
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import feather
 import warnings
-from matplotlib import style
-style.use('ggplot')
-sns.set_style("whitegrid")
-sns.set_palette('colorblind')
 warnings.filterwarnings("ignore")
 
 
+@lru_cache(maxsize=None)
+def plotting():
+    # Imports and styles matplotlib and seaborn when the first chart is drawn.
+    # Charts are plain Figures, kept out of pyplot's global figure registry
+    # (which is not thread safe and holds figures until they are closed)
+    from matplotlib.figure import Figure
+    import seaborn as sns
+    from matplotlib import style
+    style.use('ggplot')
+    sns.set_style("whitegrid")
+    sns.set_palette('colorblind')
+    return Figure, sns
+
+def checks_inputs(func):
+    # In check mode (CvrBusiness.check_inputs), fails when the method writes
+    # into a frame it was given, since cached frames are shared
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not CvrBusiness.check_inputs:
+            return func(*args, **kwargs)
+
+        frames = [arg for arg in list(args) + list(kwargs.values())
+                  if isinstance(arg, pd.DataFrame)]
+        states = [frame_state(frame) for frame in frames]
+        result = func(*args, **kwargs)
+        for frame, state in zip(frames, states):
+            if frame_state(frame) != state:
+                raise AssertionError(f"{func.__name__} changed a frame it was given")
+        return result
+
+    return wrapper
+
+
+def frame_state(data):
+    # Columns, types, index and values of a frame, to tell if it was written to
+    return (list(data.columns), list(data.dtypes.astype(str)), len(data),
+            int(pd.util.hash_pandas_object(data, index=True).sum()))
+
+
+def frame_version(data):
+    # Data tag of a frame from merge_tables, None for frames derived from it
+    # (attrs are copied to subsets, but a subset has fewer rows)
+    if data.attrs.get('data_rows') != len(data):
+        return None
+    return data.attrs.get('data_version')
+
+
 class CvrBusiness:
 
-    def __init__(self, filepath='cvr.db'):
+    # Check mode for development, set CVR_CHECK_INPUTS=1 (or this attribute)
+    # to make the analysis methods fail when they change their input frames
+    check_inputs = os.environ.get('CVR_CHECK_INPUTS') == '1'
+
+    # Tables read from the database, shared by all instances in the process.
+    # Cached frames are read only, methods must copy before changing them.
+    _table_cache = {}
+    _cache_lock = threading.Lock()
+
+    # Merged data of the current database version per profile, shared by all
+    # instances in the process (eg the warmup thread and the app's requests)
+    _merged_cache = {}
+    _merged_lock = threading.Lock()
+
+    # Clustering results, shared by all instances in the process
+    _cluster_cache = {}
+    _cluster_lock = threading.Lock()
+
+    # Companies matched by each filter, shared by all instances in the process
+    _filter_cache = {}
+    _filter_lock = threading.Lock()
+
+    # KPI tables built from the merged data, shared by all instances
+    _kpi_cache = {}
+    _kpi_lock = threading.Lock()
+
+    # Per-company charts draw one panel per company up to max_panels,
+    # larger groups are drawn as the first company against its peers
+    max_panels = 6
+
+    # Rendered charts, least recently used first, up to figure_cache_mb
+    _figure_cache = OrderedDict()
+    _figure_lock = threading.Lock()
+    figure_cache_mb = 64
+
+    # One download of the database at a time (eg warmup and a first request)
+    _download_lock = threading.Lock()
+
+    # Background warmup started by start_warmup, one per process
+    _warmup_thread = None
+    _warmup_status = {'state': 'idle', 'error': None}
+    _warmup_lock = threading.Lock()
+
+    def __init__(self, filepath='cvr.db', cache_dir='.cvr_cache', sql_join=False,
+                 chunksize=10000, errorbar=None, renderer='matplotlib'):
         self.filepath = filepath
+        # Folder for snapshots built from the database
+        self.cache_dir = cache_dir
+        # Joins the tables inside sqlite (indexing cvr.db) instead of pandas
+        self.sql_join = sql_join
+        # Rows read from sqlite at a time when streaming results
+        self.chunksize = chunksize
+        # Band around series with several rows per point, eg ('ci', 95) for
+        # seaborn's bootstrap. None averages them to one point before plotting
+        self.errorbar = errorbar
+        # Backend drawing the compare_* charts, see renderers
+        self.renderer = renderer
 
     def check_file_exists(self):
+        import gdown
+
         # File ID from google drive
         id = "1ViJNZGAqN4DmFIN5f_HtRAYrA0jeMuSw"
         output = self.filepath
 
-        # Check if the file exists
-        if os.path.exists(self.filepath):
-            return f"{output} exists"
-        else:
-            # downloads database from google drive
-            gdown.download(id=id, output=output, quiet=True)
-            return f"{output} Downloaded"
+        # Check if the file exists, waiting for a download in another thread
+        with CvrBusiness._download_lock:
+            if os.path.exists(self.filepath):
+                return f"{output} exists"
+            else:
+                # downloads database from google drive
+                gdown.download(id=id, output=output, quiet=True)
+                return f"{output} Downloaded"
 
-    def db_to_pandas(self):
+    def db_to_pandas(self, exclude=None):
         # Downloads the data
         self.check_file_exists()
 
+        # Columns that are never read from the database
+        exclude = frozenset(exclude or []) - {'cvr', 'cvr_number'}
+
+        # Tables are read once per database version and column selection
+        key = (os.path.abspath(self.filepath), self.data_version(), exclude)
+
+        # returns collection
+        return dict(self._cached_read(key, partial(self._read_tables, exclude)))
+
+    def read_columns(self, table, columns):
+        # Some columns of one table, shared like db_to_pandas, for methods
+        # that do not need the other tables (eg clustering)
+        self.check_file_exists()
+        columns = tuple(columns)
+        key = (os.path.abspath(self.filepath), self.data_version(), (table, columns))
+
+        def read():
+            conn = sqlite3.connect(self.filepath)
+            select = ', '.join(f'"{col}"' for col in columns)
+            data = self._read_chunks(conn, f'SELECT {select} FROM {table}')
+            conn.close()
+            return data
+
+        return self._cached_read(key, read)
+
+    def _cached_read(self, key, read):
+        path, version = key[:2]
+        with CvrBusiness._cache_lock:
+            if key not in CvrBusiness._table_cache:
+                # Drops tables read from older versions of the database
+                for old_key in list(CvrBusiness._table_cache):
+                    if old_key[0] == path and old_key[1] != version:
+                        del CvrBusiness._table_cache[old_key]
+                CvrBusiness._table_cache[key] = read()
+
+            return CvrBusiness._table_cache[key]
+
+    @classmethod
+    def invalidate_cache(cls, filepath=None):
+        # Forgets cached tables and merged data for one database, or for all of them
+        with cls._cache_lock:
+            for key in list(cls._table_cache):
+                if filepath is None or key[0] == os.path.abspath(filepath):
+                    del cls._table_cache[key]
+        with cls._merged_lock:
+            for tag in list(cls._merged_cache):
+                if filepath is None or tag.startswith(f"{os.path.abspath(filepath)}:"):
+                    del cls._merged_cache[tag]
+
+    def warmup(self, profile='dashboard', cluster_metrics=None, num_clusters=10):
+        # Builds the snapshot, KPI tables, filter results and the default
+        # clusterings, so the first request finds them cached
+        if cluster_metrics is None:
+            cluster_metrics = ['profit_loss', cluster_features]
+
+        data = self.merge_tables(profile)
+        self.company_kpis(data)
+        for choice in self.filters:
+            self.filter_companies(data, choice)
+        for metric in cluster_metrics:
+            self.cluster_result(metric, num_clusters)
+        return data
+
+    @classmethod
+    def start_warmup(cls, filepath='cvr.db', **kwargs):
+        # Runs warmup in a background thread, only once per process
+        with cls._warmup_lock:
+            if cls._warmup_thread is None:
+                cls._warmup_status['state'] = 'running'
+                cls._warmup_thread = threading.Thread(
+                    target=cls._run_warmup, args=(filepath, kwargs), daemon=True)
+                cls._warmup_thread.start()
+        return cls._warmup_thread
+
+    @classmethod
+    def _run_warmup(cls, filepath, kwargs):
+        try:
+            cls(filepath).warmup(**kwargs)
+            cls._warmup_status['state'] = 'ready'
+        except Exception as error:
+            # Requests still build what they need themselves
+            cls._warmup_status['error'] = repr(error)
+            cls._warmup_status['state'] = 'failed'
+
+    @classmethod
+    def warmup_state(cls):
+        # 'idle', 'running', 'ready' or 'failed'
+        return cls._warmup_status['state']
+
+    def _read_tables(self, exclude, convert=False, cvrs=None):
         # Connects to DB
         conn = sqlite3.connect(self.filepath)
+        where = self._only_companies(conn, cvrs)
 
         # Table names present in database
         table_names = ['financials', 'observations', 'company']
@@ -51,99 +248,706 @@ class CvrBusiness:
 
         # Iterate through tables in db
         for table in table_names:
+            # Only selects the columns that are not excluded
+            columns = self._table_columns(conn, table, exclude)
+            select = ', '.join(f'"{col}"' for col in columns)
+
+            # Streams the table in chunks, converting types per chunk
+            # when asked (cvr keys to text and parsed publication dates)
+            converter = partial(convert_chunk, table) if convert else None
+            key = 'cvr_number' if table == 'company' else 'cvr'
+            df = self._read_chunks(conn, f'SELECT {select} FROM {table}{where.format(key=key)}',
+                                   converter)
+
             # Creates dictionary with table name as key and data as value
-            df = pd.read_sql_query(f'SELECT * FROM {table}', conn)
             df_collection[table] = df
 
         conn.close()
-        # returns collection
         return df_collection
 
-    def merge_tables(self):
-        data = self.db_to_pandas()
+    def data_version(self):
+        # Identifies the current state of the database file
+        stat = os.stat(self.filepath)
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    def data_tag(self, profile='full'):
+        # Database, version and profile of a merged frame, see merge_tables
+        return f"{os.path.abspath(self.filepath)}:{self.data_version()}:{profile}"
+
+    def snapshot_path(self, profile='full', version=None):
+        # Snapshot file name is keyed by column profile and database version
+        # (-prepared as snapshots hold the data ready to use, see build_snapshot)
+        name = os.path.splitext(os.path.basename(self.filepath))[0]
+        version = version or self.data_version()
+        return os.path.join(self.cache_dir, f"{name}-{profile}-{version}-prepared.arrow")
+
+    def build_snapshot(self, profile='full'):
+        # Downloads the data
+        self.check_file_exists()
+
+        # The snapshot holds the merged data cleaned, typed and sorted, so
+        # loading it is only a read
+        merged_data = self._prepare_merged(self._merge_db_tables(profile))
+        return self._write_snapshot(merged_data, profile)
+
+    def _write_snapshot(self, merged_data, profile):
+        path = self.snapshot_path(profile)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Categories are stored as Arrow dictionaries. The cvr index is rebuilt
+        # on load and attrs are not kept by Arrow, so the memory report goes
+        # in the schema metadata
+        table = pa.Table.from_pandas(arrow_safe(merged_data), preserve_index=False)
+        report = json.dumps(merged_data.attrs.get('memory_report', {}))
+        table = table.replace_schema_metadata(
+            {**table.schema.metadata, b'memory_report': report.encode()})
+
+        # Writes an uncompressed Arrow IPC file so loads can memory-map it,
+        # renaming at the end so other workers never read a partial file
+        tmp_path = temp_path(path)
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+
+        # Removes snapshots of older database versions
+        name = os.path.splitext(os.path.basename(self.filepath))[0]
+        pattern = os.path.join(self.cache_dir, f"{name}-{profile}-*.arrow")
+        for old_path in glob(pattern):
+            if old_path != path:
+                remove_file(old_path)
+
+        return path
+
+    def load_snapshot(self, profile='full'):
+        # Downloads the data
+        self.check_file_exists()
+
+        # Creating the indexes writes to the database, so it is done before
+        # the version naming the snapshot is read
+        if self.sql_join:
+            self.prepare_database()
+
+        path = self.snapshot_path(profile)
+        if not os.path.exists(path):
+            self.build_snapshot(profile)
+
+        try:
+            table = feather.read_table(path, memory_map=True)
+        except (OSError, pa.ArrowInvalid):
+            # Rebuilds a damaged snapshot
+            self.build_snapshot(profile)
+            table = feather.read_table(path, memory_map=True)
+
+        # Rows are stored in cvr order, so the index needs no sort
+        merged_data = self.index_by_cvr(table.to_pandas(), sort=False)
+        merged_data.attrs['memory_report'] = json.loads(
+            table.schema.metadata.get(b'memory_report', b'{}'))
+        return merged_data
+
+    def apply_delta(self, delta_path):
+        # Applies new and changed filings from a delta file (a sqlite database
+        # with any of the three tables, or a csv of financials rows) to the
+        # database, then patches the snapshots, KPI tables and filters of the
+        # affected companies instead of rebuilding them
+        self.check_file_exists()
+        old_version = self.data_version()
+        old_kpis = self._cached_kpis(old_version)
+
+        # Upserts the delta rows, replacing rows with the same key
+        delta = read_delta(delta_path)
+        conn = sqlite3.connect(self.filepath)
+        with conn:
+            for table, rows in delta.items():
+                self._upsert(conn, table, rows, delta_keys[table])
+        conn.close()
+
+        affected = set()
+        for table, rows in delta.items():
+            key = 'cvr_number' if table == 'company' else 'cvr'
+            affected.update(rows[key].astype(str))
+        CvrBusiness.invalidate_cache(self.filepath)
+        with CvrBusiness._cluster_lock:
+            # Clusters are scaled over all companies, so they are refitted
+            CvrBusiness._cluster_cache.clear()
+
+        # Replaces the affected companies' rows in existing snapshots
+        for profile in column_profiles:
+            old_path = self.snapshot_path(profile, old_version)
+            if not os.path.exists(old_path):
+                continue
+
+            old_data = feather.read_table(old_path).to_pandas()
+            old_key = f"{os.path.abspath(self.filepath)}:{old_version}:{profile}"
+            new_rows = self._merge_db_tables(profile, cvrs=affected)
+
+            # The kept rows are prepared already. Their categories differ from
+            # the new rows', so both are joined as plain values and prepared again
+            kept = old_data[~old_data['cvr'].isin(affected)]
+            kept = kept.astype({col: object for col in kept.select_dtypes(include='category')})
+            merged_data = pd.concat([kept, new_rows], ignore_index=True)
+            merged_data = merged_data.sort_values('cvr', kind='stable', ignore_index=True)
+            merged_data = self._prepare_merged(merged_data)
+            self._write_snapshot(merged_data, profile)
+
+            if old_key in old_kpis:
+                new_key = self.data_tag(profile)
+                self._update_kpis(old_kpis[old_key], old_key, new_key, merged_data, affected)
+
+        return sorted(affected)
+
+    def _upsert(self, conn, table, rows, key):
+        columns = [col for col in rows.columns if col in self._table_columns(conn, table)]
+        rows = rows[columns].astype(object).where(rows[columns].notna(), None)
+
+        # Deletes rows with the same key (cvr keys are compared as text)
+        where = ' AND '.join(
+            f'CAST("{col}" AS TEXT) = ?' if col in ('cvr', 'cvr_number') else f'"{col}" = ?'
+            for col in key)
+        params = rows[key].assign(**{col: rows[col].astype(str) for col in key
+                                     if col in ('cvr', 'cvr_number')})
+        conn.executemany(f'DELETE FROM {table} WHERE {where}', params.values.tolist())
+
+        names = ', '.join(f'"{col}"' for col in columns)
+        marks = ', '.join('?' for _ in columns)
+        conn.executemany(f'INSERT INTO {table} ({names}) VALUES ({marks})',
+                         rows.values.tolist())
+
+    def _cached_kpis(self, version):
+        # KPI tables of a database version, from memory or from disk
+        tag = f"{os.path.abspath(self.filepath)}:{version}:"
+        with CvrBusiness._kpi_lock:
+            kpis = {key: tables for key, tables in CvrBusiness._kpi_cache.items()
+                    if key.startswith(tag)}
+
+        for profile in column_profiles:
+            key = tag + profile
+            if key in kpis:
+                continue
+            try:
+                kpis[key] = {table: feather.read_table(kpi_path).to_pandas()
+                             for table, kpi_path in self.kpi_paths(key).items()}
+            except (OSError, pa.ArrowInvalid):
+                pass
+        return kpis
+
+    def _update_kpis(self, old_kpis, old_key, new_key, data, affected):
+        # Rebuilds the KPIs of the affected companies only
+        new_kpis = self.build_kpis(data[data['cvr'].isin(affected)])
+
+        kpis = {}
+        for table in ['yearly', 'companies']:
+            old_table = old_kpis[table]
+            kept = old_table[~old_table['cvr'].astype(str).isin(affected)]
+            table_data = pd.concat([kept.astype({'cvr': str}),
+                                    new_kpis[table].astype({'cvr': str})], ignore_index=True)
+            table_data = table_data.sort_values(
+                [col for col in ['cvr', 'year'] if col in table_data], ignore_index=True)
+            kpis[table] = table_data.astype({'cvr': old_table['cvr'].dtype.name})
+
+        # Industry averages cover every company, they are one groupby
+        industries = data.groupby('industry_code', observed=True)[['return_on_assets']].mean()
+        kpis['industries'] = industries.reset_index()
+
+        with CvrBusiness._kpi_lock:
+            CvrBusiness._kpi_cache[new_key] = kpis
+        self._save_kpis(kpis, self.kpi_paths(new_key))
+
+        # Carries the cached filter results over to the new version
+        flags = new_kpis['companies'].assign(cvr=new_kpis['companies']['cvr'].astype(str))
+        with CvrBusiness._filter_lock:
+            for (version, choice), companies in list(CvrBusiness._filter_cache.items()):
+                column = self.filters.get(choice)
+                if version == old_key and isinstance(column, str):
+                    CvrBusiness._filter_cache[(new_key, choice)] = frozenset(
+                        (companies - affected) | set(flags.loc[flags[column], 'cvr']))
+
+    @staticmethod
+    def _only_companies(conn, cvrs):
+        # WHERE clause (with a {key} placeholder) limiting reads to some companies
+        if cvrs is None:
+            return ''
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS only_companies(cvr TEXT PRIMARY KEY)')
+        conn.executemany('INSERT OR IGNORE INTO only_companies VALUES (?)',
+                         [(str(cvr),) for cvr in cvrs])
+        return ' WHERE CAST({key} AS TEXT) IN (SELECT cvr FROM only_companies)'
+
+    @staticmethod
+    def _table_columns(conn, table, exclude=()):
+        return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')
+                if row[1] not in exclude]
+
+    def prepare_database(self):
+        # Indexes the cvr keys, cast to text as the tables store them with
+        # different types, so the joins can look companies up
+        conn = sqlite3.connect(self.filepath)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_financials_cvr '
+                     'ON financials(CAST(cvr AS TEXT))')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_observations_cvr '
+                     'ON observations(CAST(cvr AS TEXT))')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_company_cvr_number '
+                     'ON company(CAST(cvr_number AS TEXT))')
+        conn.commit()
+        conn.close()
+
+    def _join_in_sqlite(self, exclude, cvrs=None):
+        # Indexes are normally created by load_snapshot, this only writes
+        # when they are missing
+        self.prepare_database()
+        conn = sqlite3.connect(self.filepath)
+        where = self._only_companies(conn, cvrs).format(key='f.cvr')
+
+        financials = self._table_columns(conn, 'financials', exclude)
+        observations = self._table_columns(conn, 'observations', exclude)
+        company = self._table_columns(conn, 'company', exclude)
+
+        # Same column names as the pandas merges, clashing names get _x/_y
+        select = []
+        for col in financials:
+            if col == 'cvr':
+                select.append('CAST(f.cvr AS TEXT) AS cvr')
+            else:
+                suffix = '_x' if col in observations else ''
+                select.append(f'f."{col}" AS "{col}{suffix}"')
+        for col in observations:
+            if col != 'cvr':
+                suffix = '_y' if col in financials else ''
+                select.append(f'o."{col}" AS "{col}{suffix}"')
+        left = [name.split(' AS ')[-1].strip('"') for name in select]
+        for col in company:
+            if col == 'cvr_number':
+                select.append('CAST(c.cvr_number AS TEXT) AS cvr_number')
+            elif col in left:
+                select[left.index(col)] = select[left.index(col)][:-1] + '_x"'
+                select.append(f'c."{col}" AS "{col}_y"')
+            else:
+                select.append(f'c."{col}" AS "{col}"')
+
+        # CROSS JOIN keeps financials as the outer loop, giving the row
+        # order of the pandas merge without sorting
+        query = (f'SELECT {", ".join(select)} FROM financials f '
+                 'CROSS JOIN observations o ON CAST(o.cvr AS TEXT) = CAST(f.cvr AS TEXT) '
+                 'CROSS JOIN company c ON CAST(c.cvr_number AS TEXT) = CAST(f.cvr AS TEXT)'
+                 + where)
+
+        def convert(chunk):
+            chunk['publication_date'] = pd.to_datetime(chunk['publication_date'],
+                                                       format='mixed')
+            return chunk
+
+        merged_data = self._read_chunks(conn, query, convert)
+        conn.close()
+        return merged_data
+
+    def _read_chunks(self, conn, query, convert=None):
+        # Streams the query result, converting each chunk and keeping it as
+        # an Arrow batch, so the python objects of only one chunk are alive
+        tables = []
+        for chunk in pd.read_sql_query(query, conn, chunksize=self.chunksize):
+            if convert is not None:
+                chunk = convert(chunk)
+            table = pa.Table.from_pandas(arrow_safe(chunk), preserve_index=False)
+
+            # Text is stored once per distinct value (joins repeat it per row)
+            for i, field in enumerate(table.schema):
+                if pa.types.is_string(field.type):
+                    table = table.set_column(i, field.name,
+                                             pc.dictionary_encode(table.column(i)))
+            tables.append(table)
+
+        if not tables:
+            return pd.read_sql_query(query, conn)
+
+        # Columns with text in some chunks (see arrow_safe) are text in every
+        # chunk, as they would be when read in one chunk
+        text = {field.name for table in tables for field in table.schema
+                if pa.types.is_dictionary(field.type)}
+        for n, table in enumerate(tables):
+            for i, field in enumerate(table.schema):
+                if (field.name in text and not pa.types.is_dictionary(field.type)
+                        and not pa.types.is_null(field.type)):
+                    table = table.set_column(i, field.name, pc.dictionary_encode(
+                        table.column(i).cast(pa.string())))
+            tables[n] = table
+
+        # Columns that are NULL or integer in some chunks take the wider type
+        table = pa.concat_tables(tables, promote_options='permissive').unify_dictionaries()
+        del tables
+        data = table.to_pandas(self_destruct=True, split_blocks=True)
+
+        # Back to text columns, sharing one string object per distinct value
+        for col in data.select_dtypes(include='category').columns:
+            data[col] = data[col].astype(object)
+        return data
+
+    def _merge_db_tables(self, profile='full', cvrs=None):
+        # cvrs limits the merge to some companies (see apply_delta)
+        exclude = frozenset(column_profiles[profile]) - {'cvr', 'cvr_number'}
+        if self.sql_join:
+            merged_data = self._join_in_sqlite(exclude, cvrs)
+            return merged_data.sort_values('cvr', kind='stable', ignore_index=True)
+
+        # Reads the tables directly, they are only needed while the
+        # snapshot is built so they are kept out of the shared cache.
+        # Data cleaning and type conversion happen while reading.
+        data = self._read_tables(exclude, convert=True, cvrs=cvrs)
         df_financials = data['financials']
         df_observations = data['observations']
         df_company = data['company']
 
-        # Data Cleaning and Type conversion
-        df_financials['cvr'] = df_financials['cvr'].astype(str)
-        df_company['cvr_number'] = df_company['cvr_number'].astype(str)
-        df_financials['publication_date'] = pd.to_datetime(
-            df_financials['publication_date'], format='mixed')
-
         # Merge DataFrames
         merged_data = df_financials.merge(df_observations, on='cvr').merge(
             df_company, left_on='cvr', right_on='cvr_number')
 
+        # Stores companies in cvr order, so loads only need to index them
+        merged_data = merged_data.sort_values('cvr', kind='stable', ignore_index=True)
+
+        return merged_data
+
+    def merge_tables(self, profile='full'):
+        # Reads the merged data from the snapshot of the current database,
+        # profile names the set of columns left out (see column_profiles).
+        # The frame is read once per version and shared (so it is read only),
+        # a request made during the warmup waits for the warmup's frame
+        self.check_file_exists()
+        if self.sql_join:
+            self.prepare_database()
+        tag = self.data_tag(profile)
+
+        with CvrBusiness._merged_lock:
+            if tag not in CvrBusiness._merged_cache:
+                merged_data = self.load_snapshot(profile)
+
+                # Tags the frame so results computed from it can be cached. Subsets
+                # keep the tag, data_rows tells them apart (see frame_version)
+                merged_data.attrs['data_version'] = tag
+                merged_data.attrs['data_rows'] = len(merged_data)
+
+                # Drops the frame of older versions of the database
+                path, _, _ = tag.rsplit(':', 2)
+                for old_tag in list(CvrBusiness._merged_cache):
+                    if old_tag.startswith(f"{path}:") and old_tag.endswith(f":{profile}"):
+                        del CvrBusiness._merged_cache[old_tag]
+                CvrBusiness._merged_cache[tag] = merged_data
+
+            return CvrBusiness._merged_cache[tag]
+
+    def _prepare_merged(self, merged_data):
         # Fill missing values for Nans
         merged_data.fillna(0, inplace=True)
 
-        return merged_data
+        # Text columns holding numbers as well (eg a filled 0) become text,
+        # as they would be when the snapshot is written
+        merged_data = arrow_safe(merged_data)
 
-    def find_profitable_companies(self, merged_data):
-        # Ensure correct data types
-        merged_data['cvr'] = merged_data['cvr'].astype(str)
-        merged_data['year'] = merged_data['year'].astype(int)
-        merged_data['profit_loss'] = merged_data['profit_loss'].astype(float)
+        # Smaller types for codes and metrics
+        merged_data = self.optimize_dtypes(merged_data)
 
-        # Calculate the number of profitable years for each company
-        profit_years = merged_data.groupby(['cvr', 'year'])['profit_loss'].apply(
-            lambda x: (x > 0).sum()).reset_index()
+        # Company rows are looked up through a sorted cvr index
+        return self.index_by_cvr(merged_data)
 
-        # Summarize the total number of profitable years by company
-        profit_years = profit_years.groupby('cvr')['profit_loss'].apply(
-            lambda x: (x > 0).sum()).sort_values(ascending=False)
+    @checks_inputs
+    def find_profitable_companies(self, merged_data, min_years=5):
+        # Summarize the number of profitable years by company
+        profit_years = self.profit_years(merged_data)
+        profit_years = profit_years.sort_values(ascending=False)
 
-        # Identify companies with five or more years of profit
-        five_yr_or_more_profit_companies = profit_years[profit_years >= 5].index.tolist(
-        )
+        # Identify companies with min_years or more years of profit
+        profit_years = profit_years[profit_years >= min_years]
+        profitable_companies = profit_years.index.astype(str).tolist()
 
-        return five_yr_or_more_profit_companies
+        return profitable_companies
+
+    @staticmethod
+    @checks_inputs
+    def profit_years(merged_data):
+        # Rows with a profit (the input frame is left untouched)
+        profitable = merged_data['profit_loss'].astype(float) > 0
+        profitable_rows = merged_data.loc[profitable, ['cvr', 'year']]
 
+        # Number of distinct years with a profit for each company
+        return profitable_rows.groupby('cvr', sort=False, observed=True)['year'].nunique()
+
+    @checks_inputs
     def find_declining_companies(self, merged_data, start_year=-10, end_year=-2):
+        declining = self.declining_flags(merged_data, start_year, end_year)
+        decline_companies = declining.index[declining].tolist()
+
+        return decline_companies
+
+    @checks_inputs
+    def declining_flags(self, merged_data, start_year=-10, end_year=-2):
 
         # # Ensure 'publication_date' is in datetime format
         # if not is_datetime(merged_data['publication_date']):
         #     merged_data['publication_date'] = pd.to_datetime(merged_data['publication_date'], errors='coerce')
 
         filtered_data = merged_data.sort_values(by='publication_date')
-        decline_companies = []
-
-        # Iterate through each group
-        for cvr, group in filtered_data.groupby('cvr'):
-            if len(group) >= abs(start_year):
-                period_profit = group.iloc[start_year:end_year]['profit_loss'].sum(
-                )
-                year_before_period_profit = group.iloc[start_year -
-                                                       1:start_year]['profit_loss'].sum()
-                if period_profit < 0 and year_before_period_profit > 0:
-                    decline_companies.append(cvr)
 
-        return decline_companies
+        # Numbers each company once, then works on plain arrays
+        codes, companies = pd.factorize(filtered_data['cvr'], sort=True)
+        size = np.bincount(codes, minlength=len(companies))
+
+        # Position of each row within its company
+        position = pd.Series(codes).groupby(codes, sort=False).cumcount().to_numpy()
+
+        # Profit over the period (iloc[start_year:end_year] of each company)
+        # and over the year before it (iloc[start_year - 1:start_year])
+        profit_loss = np.nan_to_num(filtered_data['profit_loss'].to_numpy(dtype=float))
+        in_period = self._in_slice(position, size[codes], start_year, end_year)
+        in_year_before = self._in_slice(position, size[codes], start_year - 1, start_year)
+        period_profit = np.bincount(codes, weights=np.where(in_period, profit_loss, 0),
+                                    minlength=len(companies))
+        year_before_period_profit = np.bincount(
+            codes, weights=np.where(in_year_before, profit_loss, 0), minlength=len(companies))
+
+        # Only companies with enough years are considered
+        declining = ((size >= abs(start_year)) & (period_profit < 0)
+                     & (year_before_period_profit > 0))
+
+        return pd.Series(declining, index=pd.Index(np.asarray(companies), name='cvr'))
+
+    @staticmethod
+    def _in_slice(position, size, start, stop):
+        # Marks the rows each group would return for group.iloc[start:stop]
+        start = np.clip(np.where(start < 0, size + start, start), 0, size)
+        stop = np.clip(np.where(stop < 0, size + stop, stop), 0, size)
+        return (position >= start) & (position < stop)
 
+    @checks_inputs
     def find_low_debt_companies(self, data):
             # Ensure the columns exist and are of the correct type
             if 'debt_obligations' in data.columns and 'equity' in data.columns:
-                data['debt_obligations'] = data['debt_obligations'].astype(float)
-                data['equity'] = data['equity'].astype(float)
-
-                # Calculate the debt-to-equity ratio
-                data['debt_to_equity'] = data['debt_obligations'] / data['equity']
+                # Calculate the debt-to-equity ratio (the input frame is left untouched)
+                debt_to_equity = (data['debt_obligations'].astype(float)
+                                  / data['equity'].astype(float))
 
-                # Identify companies with low debt-to-equity ratio
-                low_debt_companies = data[data['debt_to_equity']
-                                        < 0.4]['cvr'].unique()
+                # Identify companies with low debt-to-equity ratio, as an array of
+                # cvr strings (not a categorical carrying every company)
+                low_debt_companies = data.loc[debt_to_equity < 0.4, 'cvr'].astype(str).unique()
                 return low_debt_companies
             else:
                 return "Required columns not found in the data"
     
-    def cluster_companies(self, metric='profit_loss'):
-        # load financial data
-        data = self.db_to_pandas()
-        financials = data['financials']
+    @checks_inputs
+    def company_kpis(self, data):
+        # Frames from merge_tables carry their data version, so the KPI
+        # tables are built once per version and kept next to the snapshot.
+        # Subsets (eg filtered data) are built each time
+        key = frame_version(data)
+        if key is None:
+            return self.build_kpis(data)
+
+        with CvrBusiness._kpi_lock:
+            if key not in CvrBusiness._kpi_cache:
+                paths = self.kpi_paths(key)
+                try:
+                    kpis = {table: feather.read_table(path, memory_map=True).to_pandas()
+                            for table, path in paths.items()}
+                except (OSError, pa.ArrowInvalid):
+                    kpis = self.build_kpis(data)
+                    self._save_kpis(kpis, paths)
+
+                # Drops tables built from older versions of the data
+                for old_key in list(CvrBusiness._kpi_cache):
+                    if old_key != key:
+                        del CvrBusiness._kpi_cache[old_key]
+                CvrBusiness._kpi_cache[key] = kpis
+
+            return CvrBusiness._kpi_cache[key]
+
+    def kpi_paths(self, key):
+        # KPI file names are keyed by the data tag (database, version, profile)
+        name = os.path.splitext(os.path.basename(self.filepath))[0]
+        version = key.rsplit(':', 2)[1]
+        digest = hashlib.md5(key.encode()).hexdigest()[:12]
+        return {table: os.path.join(
+                    self.cache_dir, f"{name}-kpis-{version}-{digest}-{table}.arrow")
+                for table in ['yearly', 'companies', 'industries']}
+
+    def _save_kpis(self, kpis, paths):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for table, path in paths.items():
+            tmp_path = temp_path(path)
+            try:
+                feather.write_feather(kpis[table], tmp_path, compression='uncompressed')
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Mixed type codes would change type on disk, so these
+                # tables are only kept in memory
+                return
+            os.replace(tmp_path, path)
+
+        # Removes KPI tables of older database versions
+        name = os.path.splitext(os.path.basename(self.filepath))[0]
+        for old_path in glob(os.path.join(self.cache_dir, f"{name}-kpis-*.arrow")):
+            if self.data_version() not in old_path:
+                remove_file(old_path)
+
+    @checks_inputs
+    def build_kpis(self, data):
+        # Debt to equity for every filing
+        debt_to_equity = (data['debt_obligations'].astype(float)
+                          / data['equity'].astype(float))
+        rows = pd.DataFrame({
+            'cvr': data['cvr'],
+            'year': data['year'],
+            'profit_loss': data['profit_loss'],
+            'revenue': data['revenue'],
+            'return_on_assets': data['return_on_assets'],
+            'current_ratio': data['current_ratio'],
+            'solvency_ratio': data['solvency_ratio'],
+            'debt_to_equity': debt_to_equity,
+        })
+
+        # One row per company and year
+        yearly = rows.groupby(['cvr', 'year'], observed=True).mean().reset_index()
+
+        # Industry averages
+        industries = data.groupby('industry_code', observed=True)[['return_on_assets']].mean()
+
+        # One row per company, with the flags used by the filters
+        by_company = rows.groupby('cvr', observed=True)
+        companies = pd.DataFrame({
+            'industry_code': data.groupby('cvr', observed=True)['industry_code'].first(),
+            'min_debt_to_equity': by_company['debt_to_equity'].min(),
+        })
+        latest = rows.iloc[np.argsort(data['publication_date'].to_numpy(), kind='stable')]
+        companies['latest_debt_to_equity'] = latest.groupby('cvr', observed=True)['debt_to_equity'].last()
+        # Matched as text, the categorical index of an empty result (eg a
+        # delta of loss-making filings) has codes of another type
+        profit_years = self.profit_years(data)
+        profit_years.index = profit_years.index.astype(str)
+        companies['profitable_years'] = profit_years.reindex(
+            companies.index.astype(str), fill_value=0).to_numpy()
+        companies['low_debt'] = companies['min_debt_to_equity'] < 0.4
+        companies['profitable'] = companies['profitable_years'] >= 5
+        companies['declining'] = self.declining_flags(data).reindex(
+            companies.index, fill_value=False)
+
+        return {'yearly': yearly, 'companies': companies.reset_index(),
+                'industries': industries.reset_index()}
+
+    def cluster_companies(self, metric='profit_loss', num_clusters=10,
+                          engine='kmeans', batch_size=1024):
+        result = self.cluster_result(metric, num_clusters, engine, batch_size)
+
+        # Returns num of clusters, clusters and vectorized data
+        return result['num_clusters'], result['labels'], result['vectors']
+
+    def cluster_result(self, metric='profit_loss', num_clusters=10,
+                       engine='kmeans', batch_size=1024):
+        import joblib
+
+        # Downloads the data
+        self.check_file_exists()
+
+        # Each clustering is fitted once per database version, then shared
+        # by every session and saved to disk to survive restarts
+        key = (os.path.abspath(self.filepath), self.data_version(),
+               metric_name(metric), num_clusters, engine, batch_size)
+
+        with CvrBusiness._cluster_lock:
+            if key not in CvrBusiness._cluster_cache:
+                path = self.cluster_path(metric, num_clusters, engine, batch_size)
+                try:
+                    result = joblib.load(path)
+                except Exception:
+                    result = self._fit_clusters(metric, num_clusters, engine, batch_size)
+                    self._save_cluster_result(result, path)
+                CvrBusiness._cluster_cache[key] = result
+
+            return CvrBusiness._cluster_cache[key]
+
+    def cluster_diagnostics(self, metric='profit_loss', k_values=range(2, 16),
+                            engine='kmeans', batch_size=1024, n_jobs=-1):
+        import joblib
+        from joblib import Parallel, delayed
+
+        # Downloads the data
+        self.check_file_exists()
+
+        # Inertia and silhouette score for each k, computed once per database
+        # version so the app can offer the best k without refitting
+        k_values = tuple(k_values)
+        key = (os.path.abspath(self.filepath), self.data_version(), 'diagnostics',
+               metric_name(metric), k_values, engine, batch_size)
+
+        with CvrBusiness._cluster_lock:
+            if key not in CvrBusiness._cluster_cache:
+                # Named by the first and last k and a hash of all of them, as
+                # sweeps can share their ends (eg range(2, 16) and [2, 15])
+                digest = hashlib.md5(repr(k_values).encode()).hexdigest()[:8]
+                path = self.cluster_path(metric, f"{k_values[0]}to{k_values[-1]}-{digest}",
+                                         engine, batch_size, kind='diagnostics')
+                try:
+                    result = joblib.load(path)
+                except Exception:
+                    vectors = self.cluster_vectors(metric).to_numpy()
+                    # Fits every k in parallel across cores
+                    scores = Parallel(n_jobs=n_jobs)(
+                        delayed(self._score_clusters)(vectors, k, engine, batch_size)
+                        for k in k_values)
+                    result = pd.DataFrame(scores)
+                    self._save_cluster_result(result, path)
+                CvrBusiness._cluster_cache[key] = result
+
+            return CvrBusiness._cluster_cache[key]
+
+    def best_k(self, metric='profit_loss', k_values=range(2, 16),
+               engine='kmeans', batch_size=1024):
+        # Number of clusters with the highest silhouette score
+        diagnostics = self.cluster_diagnostics(metric, k_values, engine, batch_size)
+        return int(diagnostics.loc[diagnostics['silhouette'].idxmax(), 'k'])
+
+    @staticmethod
+    def _score_clusters(vectors, num_clusters, engine, batch_size, sample_size=10000):
+        from sklearn.metrics import silhouette_score
+
+        model = CvrBusiness.fit_cluster_model(vectors, num_clusters, engine, batch_size)
+
+        # Silhouette is quadratic in the number of companies, so large
+        # populations are scored on a sample
+        sample_size = sample_size if len(vectors) > sample_size else None
+        silhouette = silhouette_score(vectors, model.labels_, sample_size=sample_size,
+                                      random_state=42)
+
+        return {'k': num_clusters, 'inertia': model.inertia_, 'silhouette': silhouette}
+
+    def cluster_path(self, metric='profit_loss', num_clusters=10,
+                     engine='kmeans', batch_size=1024, kind='clusters'):
+        # Cluster file name is keyed by metric, k, engine and database version
+        name = os.path.splitext(os.path.basename(self.filepath))[0]
+        if engine == 'minibatch':
+            engine = f"{engine}{batch_size}"
+        return os.path.join(
+            self.cache_dir,
+            f"{name}-{kind}-{metric_name(metric)}-{num_clusters}-{engine}-{self.data_version()}.joblib")
+
+    def _save_cluster_result(self, result, path):
+        import joblib
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        tmp_path = temp_path(path)
+        joblib.dump(result, tmp_path)
+        os.replace(tmp_path, path)
+
+        # Removes results of older database versions
+        for old_path in glob(path.replace(self.data_version(), '*')):
+            if old_path != path:
+                remove_file(old_path)
+
+    def cluster_vectors(self, metric='profit_loss'):
+        from sklearn.preprocessing import MinMaxScaler
+
+        # metric is one column, or a list of columns (eg cluster_features)
+        metrics = [metric] if isinstance(metric, str) else list(metric)
+
+        # load the financial columns used (shared copy, so new columns go on a copy)
+        financials = self.read_columns(
+            'financials', ['cvr', 'reporting_period_end_date', *dict.fromkeys(metrics)])
         
         # Extract companies operating year
-        financials['operation_year'] = pd.to_datetime(financials['reporting_period_end_date']).dt.year
+        financials = financials.assign(
+            operation_year=pd.to_datetime(financials['reporting_period_end_date']).dt.year)
         
         # Find number of operating years
         companies_with_5_years = financials.groupby('cvr')['operation_year'].count()
@@ -154,137 +958,514 @@ class CvrBusiness:
         # Filters financial data for those companies
         filtered_financials = financials[financials['cvr'].isin(companies_with_5_years)]
 
-        # Normalize the 'net income' (assuming 'profit_loss' as net income)
+        # Normalize each metric to the same range (assuming 'profit_loss' as net income),
+        # missing values are put in the middle of the range
         scaler = MinMaxScaler(feature_range=(-1, 1))
-        # Creates the normalized_profit_loss
-        filtered_financials['normalized_profit_loss'] = scaler.fit_transform(filtered_financials[[metric]])
-        
-        # Create 5-year vectors for each company
-        vectorized_data = filtered_financials.groupby('cvr').apply(lambda x: x.sort_values('operation_year').tail(5)['normalized_profit_loss'].values)
-        vectorized_data = vectorized_data[vectorized_data.map(len) == 5]  # Ensuring all vectors have length 5
-        
-        # Convert to DataFrame
-        vectorized_data = pd.DataFrame(vectorized_data.tolist(), index=vectorized_data.index)
-        
-        # Apply K-means clustering
-        num_clusters = 10  # Finds 10 clusters
-        kmeans = KMeans(n_clusters=num_clusters, random_state=42)
-        clusters = kmeans.fit_predict(vectorized_data)
-        
-        # Returns num of clusters, clusters and vectorized data
-        return num_clusters, clusters, vectorized_data
-    
+        normalized = np.nan_to_num(scaler.fit_transform(filtered_financials[metrics]))
+
+        # Create 5-year vectors for each company and metric
+        vectors = []
+        for i in range(len(metrics)):
+            metric_vectors, cvrs = self.company_vectors(
+                filtered_financials['cvr'], filtered_financials['operation_year'],
+                normalized[:, i])
+            vectors.append(metric_vectors)
+
+        # Convert to DataFrame, one column per year (per metric when several)
+        if len(metrics) == 1:
+            columns = None
+        else:
+            columns = [f"{m}_{year}" for m in metrics for year in range(5)]
+        return pd.DataFrame(np.hstack(vectors), index=pd.Index(cvrs, name='cvr'),
+                            columns=columns)
+
+    def _fit_clusters(self, metric, num_clusters, engine='kmeans', batch_size=1024):
+        vectorized_data = self.cluster_vectors(metric)
+        model = self.fit_cluster_model(vectorized_data.to_numpy(), num_clusters,
+                                       engine, batch_size)
+
+        return {
+            'num_clusters': num_clusters,
+            'labels': model.labels_,
+            'centroids': model.cluster_centers_,
+            'inertia': model.inertia_,
+            'vectors': vectorized_data,
+        }
+
+    @staticmethod
+    def fit_cluster_model(vectors, num_clusters, engine='kmeans', batch_size=1024,
+                          epochs=3):
+        from sklearn.cluster import KMeans, MiniBatchKMeans
+
+        if engine == 'kmeans':
+            # Apply K-means clustering on all companies at once
+            model = KMeans(n_clusters=num_clusters, random_state=42)
+            model.fit(vectors)
+            return model
+
+        if engine == 'minibatch':
+            # Streams shuffled batches through partial_fit, so each step only
+            # touches batch_size companies
+            model = MiniBatchKMeans(n_clusters=num_clusters, batch_size=batch_size,
+                                    random_state=42)
+            rng = np.random.default_rng(42)
+            for _ in range(epochs):
+                order = rng.permutation(len(vectors))
+                for start in range(0, len(vectors), batch_size):
+                    batch = vectors[order[start:start + batch_size]]
+                    if len(batch) >= num_clusters:
+                        model.partial_fit(batch)
+
+            # Assigns every company in batches as well
+            labels = np.concatenate([
+                model.predict(vectors[start:start + batch_size])
+                for start in range(0, len(vectors), batch_size)])
+            model.labels_ = labels
+            model.inertia_ = float(((vectors - model.cluster_centers_[labels]) ** 2).sum())
+            return model
+
+        raise ValueError(f"Unknown clustering engine: {engine}")
     
-    def plot_clusters(self):
-        
-        num_clusters, clusters, data = self.cluster_companies()
+    @staticmethod
+    def company_vectors(cvr, year, values, length=5):
+        # Builds one row per company from its last `length` values by year,
+        # using one global sort instead of a python function per company
+        order = pd.DataFrame({'cvr': np.asarray(cvr), 'year': np.asarray(year),
+                              'value': np.asarray(values)})
+        order = order.sort_values(['cvr', 'year'], kind='stable')
+
+        # Position of each row counted from the company's latest year
+        from_end = order.groupby('cvr', sort=False).cumcount(ascending=False).to_numpy()
+        sizes = order.groupby('cvr', sort=False)['cvr'].transform('size').to_numpy()
+
+        # Keeps the companies with a full vector and their last rows
+        keep = (from_end < length) & (sizes >= length)
+        order = order[keep]
+        codes, cvrs = pd.factorize(order['cvr'], sort=True)
+
+        vectors = np.empty((len(cvrs), length), dtype=np.float32)
+        vectors[codes, length - 1 - from_end[keep]] = order['value'].to_numpy()
+
+        return vectors, cvrs
+
+    def plot_clusters(self, metric='profit_loss', num_clusters=10,
+                      engine='kmeans', batch_size=1024):
+        Figure, _ = plotting()
+
+        num_clusters, clusters, data = self.cluster_companies(
+            metric, num_clusters, engine, batch_size)
         
         # Analyzing the clusters (Plotting mean of clusters for visualization)
         
-        fig,  ax = plt.subplots(figsize=(10, 6))
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
         for i in range(num_clusters):
             cluster_mean = data[clusters == i].mean()
-            plt.plot(cluster_mean, label=f'Cluster {i}')
-        plt.legend()
-        plt.title('Mean of Financial Performance Clusters')
+            ax.plot(cluster_mean, label=f'Cluster {i}')
+        ax.legend()
+        ax.set_title('Mean of Financial Performance Clusters')
         
         return fig
    
     
-    def filter_cluster_companies(self, choice=0):
-        _ ,clusters, data = self.cluster_companies()
+    def filter_cluster_companies(self, choice=0, metric='profit_loss', num_clusters=10,
+                                 engine='kmeans', batch_size=1024):
+        _ ,clusters, data = self.cluster_companies(metric, num_clusters, engine, batch_size)
         companies_in_cluster = data.index[clusters == choice]
         return companies_in_cluster
 
-    def analyze_companies(self, data, analysis_choices):
-
-        if 'low_debt' in analysis_choices and len(analysis_choices) == 1:
-            low_debt_companies = self.find_low_debt_companies(data)
-            return low_debt_companies
-        elif 'declining' in analysis_choices and len(analysis_choices) == 1:
-            decline_companies = self.find_declining_companies(data)
-            return decline_companies
-        elif 'profitable' in analysis_choices and len(analysis_choices) == 1:
-            profitable_companies = self.find_profitable_companies(data)
-            return profitable_companies
-        elif 'low_debt' in analysis_choices and 'declining' in analysis_choices and len(analysis_choices) == 2:
-            low_debt_companies = self.find_low_debt_companies(data)
-            fil_low = data[data['cvr'].isin(low_debt_companies)]
-            decline_companies = self.find_declining_companies(fil_low)
-            return set(low_debt_companies) and set(decline_companies)
-
-        elif 'low_debt' in analysis_choices and 'profitable' in analysis_choices and len(analysis_choices) == 2:
-            low_debt_companies = self.find_low_debt_companies(data)
-            fil_low = data[data['cvr'].isin(low_debt_companies)]
-            profitable_companies = self.find_profitable_companies(fil_low)
-            return set(low_debt_companies) and set(profitable_companies)
-
-        elif 'profitable' in analysis_choices and 'declining' in analysis_choices and len(analysis_choices) == 2:
-            profitable_companies = self.find_profitable_companies(data)
-            fil_prof = data[data['cvr'].isin(profitable_companies)]
-            decline_companies = self.find_declining_companies(fil_prof)
-            return set(profitable_companies) and set(decline_companies)
-
-        elif 'profitable' in analysis_choices and 'declining' in analysis_choices and 'low_debt' in analysis_choices and len(analysis_choices) == 3:
-            profitable_companies = self.find_profitable_companies(data)
-            filer_prof = data[data['cvr'].isin(profitable_companies)]
-            decline_companies = self.find_declining_companies(filer_prof)
-            low_debt_companies = self.find_low_debt_companies(filer_prof)
-            return set(profitable_companies) & set(decline_companies) & set(low_debt_companies)
+    def chart(self, plot, data, cvrs, metric=None, filters=()):
+        # A compare_* chart drawn by the renderer, as PNG bytes for matplotlib.
+        # Charts are cached per plot, companies, filters, metric, renderer and
+        # data version, so a rerun only draws the charts whose inputs changed
+        version = data.attrs.get('data_version')
+        key = (plot, tuple(cvrs), tuple(sorted(filters)), metric, self.errorbar,
+               self.renderer, version, len(data))
+
+        method = getattr(self, plot)
+        if plot == 'compare_companies_profit':
+            spec = partial(method, cvrs, data)
+        elif metric is not None:
+            spec = partial(method, data, cvrs, metric)
         else:
+            spec = partial(method, data, cvrs)
+
+        if version is None:
+            return self.render_png(self.render(spec()))
+        return self._cached_chart(key, lambda: self.render(spec()))
+
+    def cluster_png(self, metric='profit_loss', num_clusters=10,
+                    engine='kmeans', batch_size=1024):
+        # PNG of plot_clusters, cached like chart
+        key = ('plot_clusters', os.path.abspath(self.filepath), self.data_version(),
+               metric_name(metric), num_clusters, engine, batch_size)
+        return self._cached_chart(key, partial(
+            self.plot_clusters, metric, num_clusters, engine, batch_size))
+
+    def _cached_chart(self, key, draw):
+        with CvrBusiness._figure_lock:
+            if key in CvrBusiness._figure_cache:
+                CvrBusiness._figure_cache.move_to_end(key)
+                return CvrBusiness._figure_cache[key][0]
+
+        chart = self.render_png(draw())
+        # plotly figures are sized by the JSON sent to the browser
+        size = len(chart) if isinstance(chart, (bytes, str)) else len(chart.to_json())
+
+        with CvrBusiness._figure_lock:
+            CvrBusiness._figure_cache[key] = (chart, size)
+            # Evicts the least recently used charts above the memory cap
+            total = sum(size for _, size in CvrBusiness._figure_cache.values())
+            while total > self.figure_cache_mb * 1e6 and len(CvrBusiness._figure_cache) > 1:
+                _, (_, size) = CvrBusiness._figure_cache.popitem(last=False)
+                total -= size
+        return chart
+
+    @staticmethod
+    def render_png(fig):
+        # Messages (eg a wrong number of cvrs) and figures of other
+        # renderers are passed through
+        if not hasattr(fig, 'savefig'):
+            return fig
+
+        # Same settings as st.pyplot. The figure is cleared once drawn, so
+        # its artists and data are freed even if a caller keeps it
+        buffer = BytesIO()
+        fig.savefig(buffer, format='png', dpi=200, bbox_inches='tight')
+        fig.clear()
+        return buffer.getvalue()
+
+    def render(self, spec, renderer=None):
+        # Draws a chart spec (see chart_spec) with one of the renderers
+        if isinstance(spec, str):
+            return spec
+
+        render = self.renderers[renderer or self.renderer]
+        if isinstance(render, str):
+            render = getattr(self, render)
+        return render(spec)
+
+    @classmethod
+    def register_renderer(cls, name, func):
+        # func(spec) returns a figure, see render_matplotlib
+        cls.renderers = {**cls.renderers, name: func}
+
+    @staticmethod
+    def render_matplotlib(spec):
+        import matplotlib
+        Figure, sns = plotting()
+
+        panels = spec['panels']
+        rows, columns = grid(spec)
+        width, height = spec['figsize']
+        fig = Figure(figsize=(width, height * rows))
+        axes = fig.subplots(rows, columns, squeeze=False).ravel()
+        for ax in axes[len(panels):]:
+            ax.set_visible(False)
+        for ax, chart_panel in zip(axes, panels):
+            twin = None
+            for layer in chart_panel['layers']:
+                target = ax
+                if layer.get('secondary'):
+                    twin = twin or ax.twinx()
+                    target = twin
+
+                if layer['kind'] == 'hline':
+                    target.axhline(y=layer['y'], linestyle='--', color=layer['color'],
+                                   label=layer['label'])
+                    continue
+                if layer['kind'] == 'band':
+                    band_data = layer['data']
+                    target.fill_between(band_data[layer['x']], band_data[layer['low']],
+                                        band_data[layer['high']], color=layer['color'],
+                                        alpha=0.3, label=layer['label'])
+                    continue
+
+                options = {name: layer[name] for name in ['hue', 'style', 'label', 'color']
+                           if layer.get(name) is not None}
+                errorbar = spec['errorbar'] if layer.get('band', True) else None
+                plot = sns.lineplot if layer['kind'] == 'line' else sns.barplot
+                plot(ax=target, data=layer['data'], x=layer['x'], y=layer['y'],
+                     errorbar=errorbar, **options)
+
+            ax.set_title(chart_panel['title'])
+            ax.set_xlabel(chart_panel['xlabel'])
+            label_color = matplotlib.rcParams['axes.labelcolor']
+            ax.set_ylabel(chart_panel['ylabel'],
+                          color=axis_color(chart_panel, False) or label_color)
+            if twin is not None:
+                twin.set_ylabel(chart_panel['y2label'],
+                                color=axis_color(chart_panel, True) or label_color)
+            if chart_panel['legend']:
+                ax.legend()
+
+        if spec['title']:
+            fig.suptitle(spec['title'])
+        fig.tight_layout()
+        return fig
+
+    @staticmethod
+    def render_plotly(spec):
+        # Interactive figure, points with several rows are averaged (no band)
+        import plotly.graph_objects as go
+        from plotly.subplots import make_subplots
+
+        panels = spec['panels']
+        rows, columns = grid(spec)
+        secondary = [{'secondary_y': any(layer.get('secondary') for layer in chart_panel['layers'])}
+                     for chart_panel in panels]
+        secondary += [{}] * (rows * columns - len(panels))
+        fig = make_subplots(rows=rows, cols=columns,
+                            specs=[secondary[i:i + columns] for i in range(0, len(secondary), columns)],
+                            subplot_titles=[chart_panel['title'] or '' for chart_panel in panels])
+
+        # Reference lines are collected and added in one layout update,
+        # add_hline relayouts the figure for each panel
+        shapes, notes = [], []
+        for i, chart_panel in enumerate(panels):
+            row, col = i // columns + 1, i % columns + 1
+            for layer in chart_panel['layers']:
+                if layer['kind'] == 'hline':
+                    axes = fig.get_subplot(row, col)
+                    x = 'x' + axes.xaxis.plotly_name[len('xaxis'):]
+                    y = 'y' + axes.yaxis.plotly_name[len('yaxis'):]
+                    shapes.append(dict(type='line', xref=f'{x} domain', x0=0, x1=1,
+                                       yref=y, y0=layer['y'], y1=layer['y'],
+                                       line=dict(dash='dash', color=layer['color'])))
+                    if layer['label']:
+                        notes.append(dict(text=layer['label'], showarrow=False,
+                                          xref=f'{x} domain', x=1, xanchor='right',
+                                          yref=y, y=layer['y'], yanchor='bottom'))
+                    continue
+                if layer['kind'] == 'band':
+                    band_data = layer['data']
+                    fig.add_trace(go.Scatter(x=band_data[layer['x']], y=band_data[layer['low']],
+                                             mode='lines', line=dict(width=0), showlegend=False),
+                                  row=row, col=col)
+                    fig.add_trace(go.Scatter(x=band_data[layer['x']], y=band_data[layer['high']],
+                                             mode='lines', line=dict(width=0), fill='tonexty',
+                                             fillcolor='rgba(128, 128, 128, 0.3)',
+                                             name=layer['label']),
+                                  row=row, col=col)
+                    continue
+
+                data = layer['data']
+                if layer.get('hue'):
+                    groups = data.groupby(layer['hue'], observed=True)
+                else:
+                    groups = [(layer['label'], data)]
+                for name, group in groups:
+                    points = group.groupby(layer['x'])[layer['y']].mean()
+                    if layer['kind'] == 'line':
+                        trace = go.Scatter(x=points.index, y=points.to_numpy(), mode='lines',
+                                           name=str(name), line=dict(color=layer.get('color')))
+                    else:
+                        trace = go.Bar(x=points.index.astype(str), y=points.to_numpy(),
+                                       name=str(name), marker_color=layer.get('color'))
+                    if layer.get('secondary'):
+                        fig.add_trace(trace, row=row, col=col, secondary_y=True)
+                    else:
+                        fig.add_trace(trace, row=row, col=col)
+
+            fig.update_xaxes(title_text=chart_panel['xlabel'], row=row, col=col)
+            fig.update_yaxes(title_text=chart_panel['ylabel'], row=row, col=col)
+            if secondary[i]['secondary_y']:
+                fig.update_yaxes(title_text=chart_panel['y2label'], row=row, col=col,
+                                 secondary_y=True)
+
+        fig.update_layout(title_text=spec['title'], height=spec['figsize'][1] * 80 * rows,
+                          shapes=shapes, annotations=list(fig.layout.annotations) + notes)
+        return fig
+
+    @checks_inputs
+    def analyze_companies(self, data, analysis_choices):
+        if not analysis_choices:
             return 'No choice was made'
 
-    def apply_filter(self, filters_cvrs, data):
-        filtered_data = data[data['cvr'].isin(filters_cvrs)]
-        return filtered_data
+        # Companies matching every selected filter
+        companies = None
+        for choice in analysis_choices:
+            if choice not in self.filters:
+                return f"Unknown filter: {choice}"
 
-    def compare_companies_profit(self, cvrs, data):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
+            choice_companies = self.filter_companies(data, choice)
+            if isinstance(choice_companies, str):
+                return choice_companies
 
-        # Filter data for the provided CVRs
-        filtered_data = data[data['cvr'].isin(cvrs)]
+            if companies is None:
+                companies = choice_companies
+            else:
+                companies = companies & choice_companies
+
+        return sorted(companies)
+
+    @checks_inputs
+    def filter_companies(self, data, choice):
+        # Frames from merge_tables carry their data version, so each filter
+        # runs once per version and later selections are set intersections
+        version = frame_version(data)
+        key = (version, choice)
+
+        if version is not None:
+            with CvrBusiness._filter_lock:
+                if key in CvrBusiness._filter_cache:
+                    return CvrBusiness._filter_cache[key]
+
+        companies = self.filters[choice]
+        if isinstance(companies, str):
+            # Names a flag column of the company KPI table
+            try:
+                kpis = self.company_kpis(data)['companies']
+            except KeyError:
+                return "Required columns not found in the data"
+            companies = kpis.loc[kpis[companies], 'cvr']
+        else:
+            companies = companies(self, data)
+        if isinstance(companies, str):
+            # Message about missing columns
+            return companies
+        companies = frozenset(companies)
+
+        if version is not None:
+            with CvrBusiness._filter_lock:
+                # Drops filters computed on older versions of the data
+                for old_key in list(CvrBusiness._filter_cache):
+                    if old_key[0] != version:
+                        del CvrBusiness._filter_cache[old_key]
+                CvrBusiness._filter_cache[key] = companies
+
+        return companies
+
+    @classmethod
+    def register_filter(cls, name, func):
+        # Adds a filter to analyze_companies, func is a flag column of the
+        # company KPI table or func(cvr_business, data) returning cvrs
+        cls.filters = {**cls.filters, name: func}
+        with cls._filter_lock:
+            cls._filter_cache.clear()
 
-        # Create a matplotlib figure and axis
-        fig, ax = plt.subplots(figsize=(12, 6))
+    @staticmethod
+    def optimize_dtypes(data, max_unique_ratio=0.5):
+        # Shrinks the merged data: categorical codes, float32 metrics and
+        # the smallest integer types, reporting the saving in data.attrs
+        before = data.memory_usage(deep=True).sum()
 
-        # Setting the color palette to colorblind
-        sns.set_palette('colorblind')
+        # cvr_number repeats cvr after the join
+        data = data.drop(columns=['cvr_number'], errors='ignore')
 
-        # Plotting the data using Seaborn on the created axis
-        sns.lineplot(ax=ax, data=filtered_data, x='year',
-                     y='profit_loss', hue='cvr')
+        for col in data.columns:
+            values = data[col]
+            if col in ('cvr', 'industry_code'):
+                data[col] = values.astype('category')
+            elif values.dtype == object:
+                # Text with few distinct values, eg codes and statuses
+                if values.nunique() <= max_unique_ratio * len(values):
+                    data[col] = values.astype('category')
+            elif pd.api.types.is_float_dtype(values):
+                data[col] = values.astype(np.float32)
+            elif pd.api.types.is_integer_dtype(values):
+                data[col] = pd.to_numeric(values, downcast='integer')
+
+        after = data.memory_usage(deep=True).sum()
+        data.attrs['memory_report'] = {
+            'before_mb': round(before / 1e6, 1),
+            'after_mb': round(after / 1e6, 1),
+            'saved_mb': round((before - after) / 1e6, 1),
+        }
+        return data
 
-        # Setting plot titles and labels
-        ax.set_title('Profit/Loss Trend Comparison')
-        ax.set_xlabel('Year')
-        ax.set_ylabel('Profit/Loss')
+    @staticmethod
+    def index_by_cvr(data, sort=True):
+        # Sorts rows by cvr and indexes them by it, so the rows of a company
+        # are one slice found by binary search
+        if sort:
+            data = data.sort_values('cvr', kind='stable')
+        data.index = pd.Index(data['cvr'].to_numpy(), name='cvr_index')
+        return data
 
-        # Return the figure object
-        return fig
+    @staticmethod
+    @checks_inputs
+    def company_rows(data, cvrs):
+        # Rows of the given companies, without scanning cvr-indexed data
+        # (one binary search per company pays off for a few companies, a
+        # peer group of hundreds is one scan)
+        if (data.index.name == 'cvr_index' and data.index.is_monotonic_increasing
+                and len(cvrs) <= 100):
+            parts = [data.loc[cvr:cvr] for cvr in sorted(set(cvrs))]
+            if len(parts) == 1:
+                rows = parts[0]
+            else:
+                rows = pd.concat(parts) if parts else data.iloc[:0]
+        else:
+            rows = data[data['cvr'].isin(cvrs)]
 
-    def compare_company_metric(self, data, cvrs, metric='profit_loss'):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
+        # Plots only need the companies shown, not every cvr category
+        if isinstance(rows['cvr'].dtype, pd.CategoricalDtype):
+            rows = rows.assign(cvr=rows['cvr'].astype(str))
+        return rows
 
-        # Filter data for the provided CVRs
-        filtered_data = data[data['cvr'].isin(cvrs)].fillna(0)
+    @checks_inputs
+    def has_companies(self, data, cvrs):
+        # Whether any of the given companies is in the data
+        return not self.company_rows(data, cvrs).empty
 
-        # Create a matplotlib figure and axis
-        fig, ax = plt.subplots(figsize=(8, 5))
+    @checks_inputs
+    def apply_filter(self, filters_cvrs, data):
+        filtered_data = data[data['cvr'].isin(filters_cvrs)]
+        return filtered_data
 
-        # Plotting the data using Seaborn
-        sns.lineplot(ax=ax, data=filtered_data, x='year', y=metric, hue='cvr')
+    @checks_inputs
+    def series(self, data, x, metrics):
+        # The merge with observations repeats filings, so a company can have
+        # several rows per year or date. Unless a band is drawn (errorbar),
+        # they are averaged here to one point per company and x, the value
+        # seaborn would draw, without its bootstrap
+        if self.errorbar is not None:
+            return data
+        return data.groupby(['cvr', x], observed=True)[metrics].mean().reset_index()
+
+    @checks_inputs
+    def yearly_series(self, data, cvrs, metrics):
+        # series(company_rows(data, cvrs), 'year', metrics), read from the
+        # yearly KPI table for frames from merge_tables
+        if self.errorbar is None and frame_version(data) is not None:
+            yearly = self.company_kpis(data)['yearly']
+            if set(metrics) <= set(yearly.columns):
+                rows = yearly.loc[yearly['cvr'].isin(cvrs), ['cvr', 'year', *metrics]]
+                return rows.assign(cvr=rows['cvr'].astype(str)).reset_index(drop=True)
+
+        return self.series(self.company_rows(data, cvrs), 'year', metrics)
+
+    @checks_inputs
+    def compare_companies_profit(self, cvrs, data):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
 
-        # Setting plot titles and labels
-        ax.set_title(f"{metric.capitalize()} Trend Comparison")
-        ax.set_xlabel('Year')
-        ax.set_ylabel(metric.capitalize())
+        # One line per company
+        return chart_spec(
+            [panel([line(self.yearly_series(data, cvrs, ['profit_loss']),
+                         'year', 'profit_loss', hue='cvr')],
+                   title='Profit/Loss Trend Comparison', xlabel='Year', ylabel='Profit/Loss')],
+            figsize=(12, 6), errorbar=self.errorbar)
 
-        # Return the figure object
-        return fig
+    @checks_inputs
+    def compare_company_metric(self, data, cvrs, metric='profit_loss'):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
+
+        # Missing values count as 0 (frames from merge_tables have none)
+        if frame_version(data) is None:
+            data = self.company_rows(data, cvrs).fillna({metric: 0})
+
+        # One line per company
+        return chart_spec(
+            [panel([line(self.yearly_series(data, cvrs, [metric]), 'year', metric, hue='cvr')],
+                   title=f"{metric.capitalize()} Trend Comparison", xlabel='Year',
+                   ylabel=metric.capitalize())],
+            figsize=(8, 5), errorbar=self.errorbar)
 
     @staticmethod
+    @checks_inputs
     def missing_data(data):
         total = data.isnull().sum()
         percent = (data.isnull().sum() / data.isnull().count() * 100)
@@ -296,197 +1477,354 @@ class CvrBusiness:
         tt['types'] = types
         return np.transpose(tt)
 
+    @checks_inputs
     def compare_roa(self, data, cvrs):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
-
-        # Calculate industry averages for ROA
-        industry_roa = data.groupby('industry_code')['return_on_assets'].mean()
-
-        # Create a matplotlib figure with subplots
-        fig, axes = plt.subplots(1, 2, figsize=(12, 6))
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
+        if len(cvrs) > self.max_panels:
+            return self.compare_peers(data, cvrs, 'return_on_assets')
+
+        # Industry averages for ROA, from the KPI tables for frames from
+        # merge_tables and over the rows given for subsets (eg filtered data)
+        if frame_version(data) is not None:
+            industry_roa = self.company_kpis(data)['industries'].set_index(
+                'industry_code')['return_on_assets']
+        else:
+            industry_roa = data.groupby('industry_code', observed=True)['return_on_assets'].mean()
 
-        for i, cvr in enumerate(cvrs):
-            company_data = data[data['cvr'] == cvr]
+        # One panel per company, its ROA by year against the industry average
+        panels = []
+        for cvr in cvrs:
+            company_data = self.company_rows(data, [cvr])
+            layers = []
             if not company_data.empty:
                 industry_code = company_data['industry_code'].iloc[0]
                 avg_roa = industry_roa[industry_code]
+                company_data = self.yearly_series(data, [cvr], ['return_on_assets'])
 
-                # Plotting the company's ROA
-                sns.barplot(ax=axes[i], x='year', y='return_on_assets',
-                            data=company_data, label=f'CVR {cvr} - ROA')
+                layers = [bar(company_data, 'year', 'return_on_assets', label=f'CVR {cvr} - ROA'),
+                          hline(avg_roa, label='Industry Average', color='red')]
+            panels.append(panel(layers, title=f"CVR: {cvr}", xlabel='Year', ylabel='ROA',
+                                legend=True))
 
-                # Plotting the industry average ROA
-                axes[i].plot(company_data['year'], [avg_roa]*len(company_data),
-                             label='Industry Average', color='red', linestyle='--')
+        return chart_spec(panels, title="Return on Assets Comparison", figsize=(12, 6),
+                          errorbar=self.errorbar)
 
-                axes[i].set_title(f"CVR: {cvr}")
-                axes[i].set_xlabel('Year')
-                axes[i].set_ylabel('ROA')
-                axes[i].legend()
+    @checks_inputs
+    def compare_current_ratio_single_plot(self, data, cvrs):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
 
-        fig.suptitle("Return on Assets Comparison")
-        plt.tight_layout()
+        # Filter data for the provided CVRs
+        filtered_data = self.series(self.company_rows(data, cvrs), 'publication_date',
+                                    ['current_ratio'])
 
-        return fig
+        return chart_spec(
+            [panel([line(filtered_data, 'publication_date', 'current_ratio',
+                         hue='cvr', style='cvr')],
+                   title='Current Ratio Comparison', xlabel='Publication Date',
+                   ylabel='Current Ratio')],
+            figsize=(8, 6), errorbar=self.errorbar)
 
-    def compare_current_ratio_single_plot(self, data, cvrs):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
+    @checks_inputs
+    def compare_current_ratio(self, data, cvrs):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
+        if len(cvrs) > self.max_panels:
+            return self.compare_peers(data, cvrs, 'current_ratio')
 
-        # Filter data for the provided CVRs
-        filtered_data = data[data['cvr'].isin(cvrs)]
+        # One panel per company
+        panels = []
+        for cvr in cvrs:
+            company_data = self.series(self.company_rows(data, [cvr]), 'publication_date',
+                                       ['current_ratio'])
+            panels.append(panel(
+                [line(company_data, 'publication_date', 'current_ratio', label=f'CVR {cvr}')],
+                title=f"CVR: {cvr}", xlabel='Publication Date', ylabel='Current Ratio'))
 
-        # Create a matplotlib figure and axis
-        fig, ax = plt.subplots(figsize=(8, 6))
+        return chart_spec(panels, title="Current Ratio Comparison", figsize=(10, 5),
+                          errorbar=self.errorbar)
 
-        # Plotting the data using Seaborn
-        sns.lineplot(ax=ax, data=filtered_data, x='publication_date',
-                     y='current_ratio', hue='cvr', style='cvr')
+    @checks_inputs
+    def compare_solvency_ratio_side_by_side(self, data, cvrs):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
+        if len(cvrs) > self.max_panels:
+            return self.compare_peers(data, cvrs, 'solvency_ratio')
 
-        # Setting plot titles and labels
-        ax.set_title('Current Ratio Comparison')
-        ax.set_xlabel('Publication Date')
-        ax.set_ylabel('Current Ratio')
+        # One panel per company, with the solvency threshold
+        panels = []
+        for cvr in cvrs:
+            company_data = self.series(self.company_rows(data, [cvr]), 'publication_date',
+                                       ['solvency_ratio'])
+            panels.append(panel(
+                [line(company_data, 'publication_date', 'solvency_ratio', label=f'CVR {cvr}'),
+                 hline(1, color='red')],
+                title=f"CVR: {cvr}", xlabel='Publication Date', ylabel='Solvency Ratio'))
 
-        # Return the figure object
-        return fig
+        return chart_spec(panels, title="Solvency Ratio Comparison", figsize=(12, 6),
+                          errorbar=self.errorbar)
 
-    def compare_current_ratio(self, data, cvrs):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
+    @checks_inputs
+    def compare_solvency_ratio_combined(self, data, cvrs):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
 
-        # Create a subplot with 1 row and 2 columns
-        fig, axes = plt.subplots(1, 2, figsize=(10, 5))
+        # Both companies in one panel, with the solvency threshold
+        layers = []
+        for cvr in cvrs:
+            company_data = self.series(self.company_rows(data, [cvr]), 'publication_date',
+                                       ['solvency_ratio'])
+            layers.append(line(company_data, 'publication_date', 'solvency_ratio',
+                               label=f'CVR {cvr}'))
+        layers.append(hline(1, color='red'))
+
+        return chart_spec(
+            [panel(layers, title='Combined Solvency Ratio Trend', xlabel='Publication Date',
+                   ylabel='Solvency Ratio')],
+            figsize=(8, 6), errorbar=self.errorbar)
+
+    @checks_inputs
+    def compare_revenue_profit_loss(self, data, cvrs):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
+        if len(cvrs) > self.max_panels:
+            return self.compare_peers(data, cvrs, 'revenue')
 
-        for i, cvr in enumerate(cvrs):
-            company_data = data[data['cvr'] == cvr]
+        # One panel per company, profit/loss on a second y-axis
+        panels = []
+        for cvr in cvrs:
+            company_data = self.company_rows(data, [cvr])
+            company_data = company_data.fillna({'revenue': 0, 'profit_loss': 0})
+            company_data = self.series(company_data, 'publication_date',
+                                       ['revenue', 'profit_loss'])
+
+            panels.append(panel(
+                [line(company_data, 'publication_date', 'revenue', label='Revenue', color='blue'),
+                 line(company_data, 'publication_date', 'profit_loss', label='Profit/Loss',
+                      color='green', secondary=True)],
+                title=f"Revenue vs. Profit/Loss for CVR: {cvr}", xlabel='Publication Date',
+                ylabel='Revenue', y2label='Profit/Loss'))
+
+        return chart_spec(panels, title="Comparison of Revenue vs. Profit/Loss",
+                          figsize=(12, 6), errorbar=self.errorbar)
+
+    @checks_inputs
+    def compare_total_employee_count(self, data, cvrs):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
 
-            # Create a line plot for each company's current ratio
-            sns.lineplot(ax=axes[i], x='publication_date',
-                         y='current_ratio', data=company_data, label=f'CVR {cvr}')
-            axes[i].set_title(f"CVR: {cvr}")
-            axes[i].set_xlabel('Publication Date')
-            axes[i].set_ylabel('Current Ratio')
+        # Filter the data for the specified CVRs
+        company_data = self.company_rows(data, cvrs)
 
-        plt.suptitle("Current Ratio Comparison")
-        plt.tight_layout()
+        # Calculate total employee counts
+        filtered_data = company_data.groupby('cvr', observed=True)['employee_count'].sum().reset_index()
+
+        # one bar per company, so there is nothing to estimate a band from
+        return chart_spec(
+            [panel([bar(filtered_data, 'cvr', 'employee_count', band=False)],
+                   title='Total Employee Count Comparison', xlabel='CVR',
+                   ylabel='Total Employee Count')],
+            figsize=(15, 10), errorbar=self.errorbar)
+
+    @checks_inputs
+    def peer_stats(self, data, cvrs, metric='profit_loss'):
+        # Yearly values of a peer group: median and quartiles per year, and
+        # the percentile rank of each company among its peers that year
+        companies = self.company_rows(data, cvrs)
+        companies = companies.groupby(['cvr', 'year'], observed=True)[metric].mean().reset_index()
+
+        # Columns are reindexed, so no rows (eg unknown cvrs) give empty columns
+        by_year = companies.groupby('year')[metric]
+        years = by_year.quantile([0.25, 0.5, 0.75]).unstack().reindex(columns=[0.25, 0.5, 0.75])
+        years.columns = ['q1', 'median', 'q3']
+        years['companies'] = by_year.count()
+        companies['percentile'] = by_year.rank(pct=True) * 100
+
+        return {'years': years.reset_index(), 'companies': companies}
+
+    @checks_inputs
+    def compare_peers(self, data, cvrs, metric='profit_loss'):
+        # The first company against all of them (the peer group), with the
+        # peers drawn as a median line and interquartile band
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
+
+        stats = self.peer_stats(data, cvrs, metric)
+        years, companies = stats['years'], stats['companies']
+        if companies.empty:
+            return "None of the CVRs were found in the data."
+        focus = companies[companies['cvr'] == str(cvrs[0])]
+        name = metric.replace('_', ' ').capitalize()
+
+        return chart_spec(
+            [panel([band(years, 'year', 'q1', 'q3', label='Peers (25-75%)', color='grey'),
+                    line(years, 'year', 'median', label='Peer median', color='black'),
+                    line(focus, 'year', metric, label=f'CVR {cvrs[0]}', color='red')],
+                   title=name, xlabel='Year', ylabel=name, legend=True),
+             panel([line(focus, 'year', 'percentile', label=f'CVR {cvrs[0]}', color='red'),
+                    hline(50, label='Peer median', color='black')],
+                   title='Percentile Rank Among Peers', xlabel='Year', ylabel='Percentile',
+                   legend=True)],
+            title=f"CVR {cvrs[0]} against {companies['cvr'].nunique()} companies",
+            figsize=(12, 5), errorbar=None)
 
-        return fig
+    @staticmethod
+    @checks_inputs
+    def unique_values(data):
+        total = data.count()
+        tt = pd.DataFrame(total)
+        tt.columns = ['Total']
+        uniques = []
+        for col in data.columns:
+            unique = data[col].nunique()
+            uniques.append(unique)
+        tt['Uniques'] = uniques
+        return np.transpose(tt)
 
-    def compare_solvency_ratio_side_by_side(self, data, cvrs):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
+    @staticmethod
+    def check_cvr(cvrs):
+        if not cvrs:
+            return "Please provide at least one CVR for comparison."
+        else:
+            return cvrs
 
-        # Create a subplot with 1 row and 2 columns
-        fig, axes = plt.subplots(1, 2, figsize=(12, 6))
+    # Renderers for chart specs, name -> method name or a function of the spec
+    renderers = {
+        'matplotlib': 'render_matplotlib',
+        'plotly': 'render_plotly',
+    }
 
-        for i, cvr in enumerate(cvrs):
-            company_data = data[data['cvr'] == cvr]
+    # Filters offered by analyze_companies, name -> flag column of the
+    # company KPI table, or a function returning cvrs
+    filters = {
+        'low_debt': 'low_debt',
+        'declining': 'declining',
+        'profitable': 'profitable',
+    }
 
-            sns.lineplot(ax=axes[i], x='publication_date',
-                         y='solvency_ratio', data=company_data, label=f'CVR {cvr}')
-            axes[i].axhline(y=1, linestyle='--', color='red')
-            axes[i].set_title(f"CVR: {cvr}")
-            axes[i].set_xlabel('Publication Date')
-            axes[i].set_ylabel('Solvency Ratio')
 
-        plt.suptitle("Solvency Ratio Comparison")
-        plt.tight_layout()
+def chart_spec(panels, title=None, figsize=(8, 6), errorbar=None, columns=2):
+    # A chart independent of the plotting library: panels side by side,
+    # wrapping after `columns` panels (figsize is per row), drawn by
+    # CvrBusiness.render
+    return {'panels': panels, 'title': title, 'figsize': figsize, 'errorbar': errorbar,
+            'columns': columns}
 
-        return fig
 
-    def compare_solvency_ratio_combined(self, data, cvrs):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
+def grid(spec):
+    # Rows and columns of the panels of a chart spec
+    columns = min(len(spec['panels']), spec['columns']) or 1
+    return -(-len(spec['panels']) // columns), columns
 
-        fig, ax = plt.subplots(figsize=(8, 6))
 
-        for cvr in cvrs:
-            company_data = data[data['cvr'] == cvr]
+def panel(layers, title=None, xlabel=None, ylabel=None, y2label=None, legend=False):
+    # Layers drawn on the same axes, y2label names the secondary y-axis
+    return {'layers': layers, 'title': title, 'xlabel': xlabel, 'ylabel': ylabel,
+            'y2label': y2label, 'legend': legend}
 
-            sns.lineplot(ax=ax, x='publication_date', y='solvency_ratio',
-                         data=company_data, label=f'CVR {cvr}')
 
-        ax.axhline(y=1, linestyle='--', color='red')
-        ax.set_title('Combined Solvency Ratio Trend')
-        ax.set_xlabel('Publication Date')
-        ax.set_ylabel('Solvency Ratio')
+def line(data, x, y, hue=None, style=None, label=None, color=None, secondary=False):
+    # One line per hue value, from the x and y columns of data
+    return {'kind': 'line', 'data': data, 'x': x, 'y': y, 'hue': hue, 'style': style,
+            'label': label, 'color': color, 'secondary': secondary}
 
-        plt.tight_layout()
-        return fig
 
-    def compare_revenue_profit_loss(self, data, cvrs):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
+def bar(data, x, y, label=None, color=None, band=True):
+    # band=False draws no errorbar even when the chart has one
+    return {'kind': 'bar', 'data': data, 'x': x, 'y': y, 'label': label, 'color': color,
+            'band': band}
 
-        # Create a subplot with 1 row and 2 columns
-        fig, axes = plt.subplots(1, 2, figsize=(12, 6))
 
-        for i, cvr in enumerate(cvrs):
-            company_data = data[data['cvr'] == cvr]
-            company_data.fillna(0, inplace=True)
+def band(data, x, low, high, label=None, color=None):
+    # Shaded area between the low and high columns, eg quartiles
+    return {'kind': 'band', 'data': data, 'x': x, 'low': low, 'high': high,
+            'label': label, 'color': color}
 
-            # Create first y-axis for Revenue
-            sns.lineplot(ax=axes[i], x='publication_date', y='revenue',
-                         data=company_data, color='blue', label='Revenue')
 
-            # Create second y-axis for Profit/Loss
-            ax2 = axes[i].twinx()
-            sns.lineplot(ax=ax2, x='publication_date', y='profit_loss',
-                         data=company_data, color='green', label='Profit/Loss')
+def hline(y, label=None, color=None):
+    # Dashed reference line, eg a threshold or an average
+    return {'kind': 'hline', 'y': y, 'label': label, 'color': color}
 
-            axes[i].set_title(f"Revenue vs. Profit/Loss for CVR: {cvr}")
-            axes[i].set_xlabel('Publication Date')
-            axes[i].set_ylabel('Revenue', color='blue')
-            ax2.set_ylabel('Profit/Loss', color='green')
 
-        plt.suptitle("Comparison of Revenue vs. Profit/Loss")
-        plt.tight_layout()
+def axis_color(chart_panel, secondary):
+    # A y-axis showing a single coloured line takes its colour
+    colors = [layer.get('color') for layer in chart_panel['layers']
+              if layer['kind'] in ('line', 'bar') and bool(layer.get('secondary')) == secondary]
+    return colors[0] if len(colors) == 1 and colors[0] else None
 
-        return fig
 
-    def compare_total_employee_count(self, data, cvrs):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
+def read_delta(delta_path):
+    # Tables of a delta file, a csv holds financials rows
+    if delta_path.endswith('.csv'):
+        return {'financials': pd.read_csv(delta_path)}
 
-        # Calculate total employee counts
-        mean_counts = data.groupby('cvr')['employee_count'].sum().reset_index()
+    conn = sqlite3.connect(delta_path)
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")]
+    delta = {table: pd.read_sql_query(f'SELECT * FROM {table}', conn)
+             for table in delta_keys if table in tables}
+    conn.close()
+    return delta
 
-        # Filter the data for the specified CVRs
-        filtered_data = mean_counts[mean_counts['cvr'].isin(cvrs)]
 
-        # Create a figure and axis object
-        fig, ax = plt.subplots(figsize=(15, 10))
+def convert_chunk(table, chunk):
+    # Data Cleaning and Type conversion for a chunk read from a table
+    if table == 'financials':
+        chunk['cvr'] = chunk['cvr'].astype(str)
+        chunk['publication_date'] = pd.to_datetime(chunk['publication_date'],
+                                                   format='mixed')
+    elif table == 'company':
+        chunk['cvr_number'] = chunk['cvr_number'].astype(str)
+    return chunk
 
-        # Create the bar chart on the created axis
-        sns.barplot(x='cvr', y='employee_count', data=filtered_data, ax=ax)
-        # Update layout
-        ax.set_title('Total Employee Count Comparison')
-        ax.set_xlabel('CVR')
-        ax.set_ylabel('Total Employee Count')
 
-        return fig
+def metric_name(metric):
+    # Name of a clustering metric or list of metrics, used in cache keys
+    return metric if isinstance(metric, str) else '+'.join(metric)
 
-    @staticmethod
-    def unique_values(data):
-        total = data.count()
-        tt = pd.DataFrame(total)
-        tt.columns = ['Total']
-        uniques = []
-        for col in data.columns:
-            unique = data[col].nunique()
-            uniques.append(unique)
-        tt['Uniques'] = uniques
-        return np.transpose(tt)
 
-    @staticmethod
-    def check_cvr(cvrs):
-        if len(cvrs) != 2:
-            return "Please provide exactly two CVRs for comparison."
-        else:
-            return cvrs
+def temp_path(path):
+    # File to write before renaming to path, one per process and thread, as
+    # the warmup thread and a request can build the same file at once
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def remove_file(path):
+    # Removes a file another thread or worker may have removed already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def arrow_safe(data):
+    # Arrow needs one type per column, so text columns holding mixed
+    # python types (sqlite allows it) are stored as strings
+    data = data.copy(deep=False)
+    for col in data.select_dtypes(include='object').columns:
+        try:
+            pa.array(data[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            data[col] = data[col].where(data[col].isna(), data[col].astype(str))
+    return data
 
 
 cols_to_drop = ['pdf_url', 'secondary_industry', 'short_description', 'long_description', 'capital_partly', 'establishment_date', 'first_financial_year_start', 'last_loaded', 'email', 'reporting_period_end_date', 'website_url', 'status_valid_to', 'date_of_approval_of_annual_report', 'status_valid_from', 'description', 'name',
                 'capital_currency', 'auditor_reprimand', 'responsible_data_providers', 'industry_text', 'purpose', 'effective_date', 'industry_sector', 'company_binding', 'effective_actor', 'financial_year_start', 'last_updated', 'first_financial_year_end', 'title', 'current_revision', 'alt_names', 'unit_type', 'phone_number', 'financial_year_end', 'reporting_period_start_date']
+
+# Columns left out of the merged data for each profile
+column_profiles = {
+    'full': [],
+    'dashboard': cols_to_drop,
+}
+
+# Metrics used when clustering companies on overall financial health
+cluster_features = ['revenue', 'return_on_assets', 'current_ratio', 'solvency_ratio']
+
+# Columns identifying a row of each table when applying a delta
+delta_keys = {
+    'financials': ['cvr', 'reporting_period_start_date', 'reporting_period_end_date'],
+    'observations': ['cvr', 'year'],
+    'company': ['cvr_number'],
+}
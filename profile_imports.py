@@ -0,0 +1,54 @@
+# Measures cold import time of the modules the login page needs, failing
+# when they get slower than the budget
+import argparse
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser(description='Profile import time of the app modules')
+parser.add_argument('--modules', nargs='+', default=['cvr_analysis_1', 'ai'],
+                    help='modules imported before the login page is shown')
+parser.add_argument('--max-seconds', type=float, default=1.0,
+                    help='import time budget for all modules together')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='runs per module, the fastest one is kept')
+parser.add_argument('--top', type=int, default=5, help='slowest dependencies to show')
+args = parser.parse_args()
+
+
+def import_times(module):
+    # Each run is a fresh interpreter, so nothing is imported yet
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         capture_output=True, text=True)
+    if run.returncode != 0:
+        raise SystemExit(f'{module}: import failed\n{run.stderr.strip().splitlines()[-1]}')
+
+    # Lines are "import time: self [us] | cumulative | name", and nested
+    # imports are listed (indented) before the module importing them
+    children = []
+    for line in run.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        seconds = int(cumulative) / 1e6
+        if depth == 0 and name.strip() == module:
+            return seconds, sorted(children, reverse=True)
+        if depth == 0:
+            # interpreter startup (site) is not part of the module
+            children = []
+        elif depth == 1:
+            children.append((seconds, name.strip()))
+    raise SystemExit(f'{module}: no import time reported')
+
+total = 0
+for module in args.modules:
+    seconds, children = min(import_times(module) for _ in range(args.repeat))
+    total += seconds
+
+    print(f'{module}: {seconds:.3f}s')
+    for child_seconds, name in children[:args.top]:
+        print(f'    {name}: {child_seconds:.3f}s')
+
+print(f'total: {total:.3f}s (budget {args.max_seconds:.3f}s)')
+if total > args.max_seconds:
+    raise SystemExit('Import time is over budget')
@@ -0,0 +1,51 @@
+# Draws charts over and over, as reruns of a long running app would, and
+# checks that memory stays flat
+import argparse
+import resource
+import time
+import matplotlib.pyplot as plt
+from cvr_analysis_1 import CvrBusiness
+
+parser = argparse.ArgumentParser(description='Check chart rendering does not grow memory')
+parser.add_argument('--db', default='cvr.db', help='path to cvr database')
+parser.add_argument('--reruns', type=int, default=2000)
+parser.add_argument('--renderer', default='matplotlib', help='one of CvrBusiness.renderers')
+parser.add_argument('--max-growth-mb', type=float, default=50,
+                    help='allowed growth of peak memory after the first tenth of the reruns')
+args = parser.parse_args()
+
+cv = CvrBusiness(args.db, renderer=args.renderer)
+data = cv.merge_tables(profile='dashboard')
+companies = [str(cvr) for cvr in data['cvr'].unique()[:20]]
+plots = ['compare_companies_profit', 'compare_roa', 'compare_current_ratio',
+         'compare_solvency_ratio_side_by_side', 'compare_solvency_ratio_combined',
+         'compare_revenue_profit_loss', 'compare_total_employee_count']
+
+
+def peak_mb():
+    # Peak resident memory of the process (kilobytes on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+start = time.perf_counter()
+warm = None
+for rerun in range(args.reruns):
+    plot = plots[rerun % len(plots)]
+    cvrs = [companies[rerun % len(companies)], companies[(rerun + 1) % len(companies)]]
+
+    # Drawn without the chart cache, like a rerun with new inputs
+    method = getattr(cv, plot)
+    spec = method(cvrs, data) if plot == 'compare_companies_profit' else method(data, cvrs)
+    cv.render_png(cv.render(spec))
+
+    if rerun + 1 == max(args.reruns // 10, 1):
+        warm = peak_mb()
+    if (rerun + 1) % 200 == 0:
+        print(f'{rerun + 1} reruns: peak {peak_mb():.0f} MB, '
+              f'open pyplot figures {len(plt.get_fignums())}')
+
+growth = peak_mb() - warm
+print(f'{args.reruns} reruns in {time.perf_counter() - start:.0f}s, '
+      f'peak grew {growth:.1f} MB after warm up')
+if growth > args.max_growth_mb or plt.get_fignums():
+    raise SystemExit('Memory grew while drawing charts')
@@ -0,0 +1,48 @@
+# Shared fixtures, a small generated cvr database so tests run offline
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_database(path, companies=200, seed=0):
+    # Same tables and column types as cvr.db, with a few text columns of company.
+    # Over 127 companies, so cvr category codes are wider than int8
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE financials(cvr INTEGER, publication_date TEXT, '
+                 'reporting_period_start_date TEXT, reporting_period_end_date TEXT, '
+                 'profit_loss REAL, revenue REAL, debt_obligations REAL, equity REAL, '
+                 'return_on_assets REAL, current_ratio REAL, solvency_ratio REAL, pdf_url TEXT)')
+    conn.execute('CREATE TABLE observations(cvr TEXT, year INTEGER, employee_count INTEGER)')
+    conn.execute('CREATE TABLE company(cvr_number INTEGER, industry_code TEXT, name TEXT, '
+                 'description TEXT)')
+
+    for i in range(companies):
+        cvr = 10000000 + i
+        first_year = rng.randint(2005, 2012)
+        for year in range(first_year, first_year + rng.randint(2, 12)):
+            conn.execute('INSERT INTO financials VALUES (?,?,?,?,?,?,?,?,?,?,?,?)', (
+                cvr, f'{year + 1}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}',
+                f'{year}-01-01', f'{year}-12-31', rng.gauss(0, 1e5),
+                abs(rng.gauss(1e6, 5e5)), abs(rng.gauss(1e5, 1e5)), rng.gauss(3e5, 2e5),
+                rng.gauss(0.05, 0.1), abs(rng.gauss(1.5, 1)), rng.gauss(0.4, 0.3),
+                'http://example.com/report.pdf'))
+        for k in range(rng.randint(1, 3)):
+            conn.execute('INSERT INTO observations VALUES (?,?,?)',
+                         (str(cvr), first_year + k, rng.randint(1, 100)))
+        conn.execute('INSERT INTO company VALUES (?,?,?,?)',
+                     (cvr, str(rng.randint(1, 5)), f'Company {i}', 'lorem ipsum ' * 5))
+
+    conn.commit()
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def cvr_db(tmp_path):
+    return make_database(str(tmp_path / 'cvr.db'))
@@ -0,0 +1,23 @@
+# Cluster diagnostics are saved per sweep of k
+import pytest
+
+from cvr_analysis_1 import CvrBusiness
+
+
+@pytest.fixture
+def cv(cvr_db, tmp_path):
+    yield CvrBusiness(cvr_db, cache_dir=str(tmp_path / 'cache'))
+    CvrBusiness.invalidate_cache()
+    CvrBusiness._cluster_cache.clear()
+
+
+def test_sweeps_with_the_same_ends(cv):
+    sweep = cv.cluster_diagnostics(k_values=range(2, 6), n_jobs=1)
+    ends = cv.cluster_diagnostics(k_values=[2, 5], n_jobs=1)
+    assert sweep['k'].tolist() == [2, 3, 4, 5]
+    assert ends['k'].tolist() == [2, 5]
+
+    # After a restart both are loaded from their own files
+    CvrBusiness._cluster_cache.clear()
+    assert cv.cluster_diagnostics(k_values=[2, 5], n_jobs=1)['k'].tolist() == [2, 5]
+    assert cv.cluster_diagnostics(k_values=range(2, 6), n_jobs=1)['k'].tolist() == [2, 3, 4, 5]
@@ -0,0 +1,65 @@
+# find_declining_companies gives the same companies as the loop it replaced
+import numpy as np
+import pandas as pd
+import pytest
+
+from cvr_analysis_1 import CvrBusiness
+
+
+def declining_loop(merged_data, start_year=-10, end_year=-2):
+    # The per-company loop find_declining_companies used before it was vectorized
+    filtered_data = merged_data.sort_values(by='publication_date')
+    decline_companies = []
+
+    for cvr, group in filtered_data.groupby('cvr', observed=True):
+        if len(group) >= abs(start_year):
+            period_profit = group.iloc[start_year:end_year]['profit_loss'].sum()
+            year_before_period_profit = group.iloc[start_year - 1:start_year]['profit_loss'].sum()
+            if period_profit < 0 and year_before_period_profit > 0:
+                decline_companies.append(cvr)
+
+    return decline_companies
+
+
+def make_frame(companies=80, seed=0):
+    # Filings with 1 to 25 years per company, some missing profits and
+    # shared publication dates
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(1, 26, companies)
+    cvr = np.repeat([str(10000000 + i) for i in range(companies)], sizes)
+    profit_loss = rng.normal(0, 1e5, len(cvr))
+    profit_loss[rng.random(len(cvr)) < 0.05] = np.nan
+    days = rng.integers(0, 400, len(cvr)) * 30
+    frame = pd.DataFrame({
+        'cvr': cvr,
+        'publication_date': pd.Timestamp('2000-01-01') + pd.to_timedelta(days, unit='D'),
+        'profit_loss': profit_loss,
+    })
+    # Rows are not stored in date order
+    return frame.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+windows = [
+    (-10, -2),   # default
+    (-5, -1),
+    (-3, 0),     # empty period
+    (-2, -5),    # stop before start, empty period
+    (0, 3),      # no year before the period
+    (2, 6),      # counted from the first filing
+    (-30, -20),  # longer than any company
+    (30, 40),    # out of range
+]
+
+
+@pytest.mark.parametrize('start_year, end_year', windows)
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matches_loop(start_year, end_year, seed):
+    data = make_frame(seed=seed)
+    cv = CvrBusiness()
+
+    expected = declining_loop(data, start_year, end_year)
+    assert cv.find_declining_companies(data, start_year, end_year) == expected
+
+    # The merged data stores cvr as a category
+    data = data.assign(cvr=data['cvr'].astype('category'))
+    assert cv.find_declining_companies(data, start_year, end_year) == expected
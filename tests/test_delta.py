@@ -0,0 +1,86 @@
+# apply_delta patches the snapshot and KPI tables to what a full rebuild gives
+import shutil
+import sqlite3
+
+import pandas as pd
+import pytest
+from pyarrow import feather
+
+from cvr_analysis_1 import CvrBusiness
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    yield
+    CvrBusiness.invalidate_cache()
+    CvrBusiness._kpi_cache.clear()
+    CvrBusiness._filter_cache.clear()
+    CvrBusiness._cluster_cache.clear()
+
+
+def financials(db, cvrs):
+    conn = sqlite3.connect(db)
+    rows = pd.read_sql_query(
+        f"SELECT * FROM financials WHERE cvr IN ({', '.join(map(str, cvrs))})", conn)
+    conn.close()
+    return rows
+
+
+def mixed_delta(db, tmp_path):
+    # Changed filings of two companies and a new company in all three tables
+    rows = financials(db, [10000003, 10000010])
+    rows['profit_loss'] = rows['profit_loss'] * -3
+    rows['equity'] = 1e9
+    new = rows[rows['cvr'] == 10000003].assign(cvr=10999999)
+
+    path = str(tmp_path / 'delta.db')
+    conn = sqlite3.connect(path)
+    pd.concat([rows, new]).to_sql('financials', conn, index=False)
+    pd.DataFrame({'cvr': ['10999999'], 'year': [2010], 'employee_count': [5]}).to_sql(
+        'observations', conn, index=False)
+    pd.DataFrame({'cvr_number': [10999999], 'industry_code': ['2'], 'name': ['New'],
+                  'description': ['new company']}).to_sql('company', conn, index=False)
+    conn.close()
+    return path
+
+
+def loss_delta(db, tmp_path):
+    # Every filing of one company becomes a loss, so no affected row is profitable
+    rows = financials(db, [10000003])
+    rows['profit_loss'] = -abs(rows['profit_loss']) - 1
+
+    path = str(tmp_path / 'delta.csv')
+    rows.to_csv(path, index=False)
+    return path
+
+
+@pytest.mark.parametrize('make_delta', [mixed_delta, loss_delta])
+@pytest.mark.parametrize('sql_join', [False, True])
+def test_delta_matches_rebuild(cvr_db, tmp_path, make_delta, sql_join):
+    cache_dir = str(tmp_path / 'cache')
+    cv = CvrBusiness(cvr_db, cache_dir=cache_dir, sql_join=sql_join)
+    cv.warmup(cluster_metrics=[])
+
+    cv.apply_delta(make_delta(cvr_db, tmp_path))
+    patched = feather.read_table(cv.snapshot_path('dashboard')).to_pandas()
+    CvrBusiness._kpi_cache.clear()
+    data = cv.merge_tables('dashboard')
+    patched_kpis = cv.company_kpis(data)
+    patched_filters = {choice: cv.filter_companies(data, choice) for choice in cv.filters}
+
+    # Full rebuild of the same database
+    shutil.rmtree(cache_dir)
+    CvrBusiness.invalidate_cache()
+    CvrBusiness._kpi_cache.clear()
+    CvrBusiness._filter_cache.clear()
+    cv.build_snapshot('dashboard')
+    pd.testing.assert_frame_equal(
+        patched, feather.read_table(cv.snapshot_path('dashboard')).to_pandas())
+
+    data = cv.merge_tables('dashboard')
+    kpis = cv.company_kpis(data)
+    for table in kpis:
+        pd.testing.assert_frame_equal(patched_kpis[table], kpis[table], check_dtype=False,
+                                      check_categorical=False)
+    for choice in cv.filters:
+        assert patched_filters[choice] == cv.filter_companies(data, choice)
@@ -0,0 +1,71 @@
+# KPI tables and filters are cached for frames from merge_tables, not their subsets
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cvr_analysis_1 import CvrBusiness
+
+
+@pytest.fixture
+def cv(cvr_db, tmp_path):
+    yield CvrBusiness(cvr_db, cache_dir=str(tmp_path / 'cache'))
+    CvrBusiness.invalidate_cache()
+    CvrBusiness._kpi_cache.clear()
+    CvrBusiness._filter_cache.clear()
+
+
+def test_subsets_of_equal_length_are_not_shared(cv):
+    data = cv.merge_tables('dashboard')
+    cv.company_kpis(data)
+    kpi_files = sorted(os.listdir(cv.cache_dir))
+
+    # Two single-company subsets with as many rows, in different industries
+    sizes = data.groupby(['cvr', 'industry_code'], observed=True).size().reset_index(name='rows')
+    pairs = [group for _, group in sizes.groupby('rows') if group['industry_code'].nunique() > 1]
+    first = pairs[0].iloc[0]
+    second = pairs[0][pairs[0]['industry_code'] != first['industry_code']].iloc[0]
+
+    for company in [first, second]:
+        subset = cv.apply_filter([company['cvr']], data)
+        industries = cv.company_kpis(subset)['industries']
+        assert industries['industry_code'].tolist() == [company['industry_code']]
+
+        spec = cv.compare_roa(subset, [company['cvr']])
+        industry_avg = spec['panels'][0]['layers'][1]['y']
+        assert industry_avg == pytest.approx(subset['return_on_assets'].mean())
+
+    # Subsets are not written next to the snapshot
+    assert sorted(os.listdir(cv.cache_dir)) == kpi_files
+
+
+def test_filters_of_subsets(cv):
+    data = cv.merge_tables('dashboard')
+    companies = sorted(data['cvr'].unique().astype(str))
+    subset = cv.apply_filter(companies[:20], data)
+
+    assert cv.filter_companies(subset, 'low_debt') <= frozenset(companies[:20])
+    low_debt = cv.find_low_debt_companies(data)
+    assert isinstance(low_debt, np.ndarray) and isinstance(low_debt[0], str)
+    assert cv.filter_companies(data, 'low_debt') == frozenset(low_debt)
+
+
+def test_charts_read_kpi_tables(cv):
+    data = cv.merge_tables('dashboard')
+    cvrs = sorted(data['cvr'].unique().astype(str))[:3]
+    industries = cv.company_kpis(data)['industries'].set_index('industry_code')
+
+    # The same points as averaging the rows, for frames from merge_tables
+    # (read from the yearly table) and their subsets
+    subset = cv.apply_filter(cvrs, data)
+    for metric in ['profit_loss', 'return_on_assets', 'employee_count']:
+        expected = cv.series(cv.company_rows(data, cvrs), 'year', [metric])
+        pd.testing.assert_frame_equal(cv.yearly_series(data, cvrs, [metric]), expected,
+                                      check_dtype=False)
+        pd.testing.assert_frame_equal(cv.yearly_series(subset, cvrs, [metric]), expected,
+                                      check_dtype=False)
+
+    for cvr, chart_panel in zip(cvrs, cv.compare_roa(data, cvrs)['panels']):
+        industry_code = data.loc[cvr:cvr, 'industry_code'].iloc[0]
+        assert chart_panel['layers'][1]['y'] == industries.loc[industry_code, 'return_on_assets']
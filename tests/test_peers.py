@@ -0,0 +1,51 @@
+# Peer benchmarks of groups with companies missing from the data
+import pytest
+
+from cvr_analysis_1 import CvrBusiness
+
+
+@pytest.fixture
+def cv(cvr_db, tmp_path):
+    yield CvrBusiness(cvr_db, cache_dir=str(tmp_path / 'cache'))
+    CvrBusiness.invalidate_cache()
+    CvrBusiness._kpi_cache.clear()
+    CvrBusiness._filter_cache.clear()
+
+
+@pytest.fixture
+def data(cv):
+    return cv.merge_tables('dashboard')
+
+
+def test_unknown_cvrs(cv, data):
+    cvrs = [str(cvr) for cvr in range(7)]
+
+    stats = cv.peer_stats(data, cvrs)
+    assert stats['years'].empty and stats['companies'].empty
+    assert list(stats['years'].columns) == ['year', 'q1', 'median', 'q3', 'companies']
+
+    # compare_roa draws groups above max_panels with compare_peers
+    assert len(cvrs) > cv.max_panels
+    for plot in ['compare_peers', 'compare_roa']:
+        for renderer in cv.renderers:
+            cv.renderer = renderer
+            assert cv.chart(plot, data, cvrs) == "None of the CVRs were found in the data."
+
+
+def test_cvrs_outside_filtered_data(cv, data):
+    companies = sorted(data['cvr'].unique().astype(str))
+    filtered = cv.apply_filter(companies[:10], data)
+    cvrs = companies[10:18]
+
+    assert cv.compare_peers(filtered, cvrs) == "None of the CVRs were found in the data."
+    assert cv.compare_current_ratio(filtered, cvrs) == "None of the CVRs were found in the data."
+
+
+def test_peer_median(cv, data):
+    cvrs = sorted(data['cvr'].unique().astype(str))[:20]
+    stats = cv.peer_stats(data, cvrs)
+
+    rows = data[data['cvr'].isin(cvrs)]
+    expected = rows.groupby(['cvr', 'year'], observed=True)['profit_loss'].mean().groupby('year').median()
+    assert stats['years'].set_index('year')['median'].to_numpy() == pytest.approx(expected.to_numpy())
+    assert stats['companies']['percentile'].between(0, 100).all()
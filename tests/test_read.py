@@ -0,0 +1,49 @@
+# Reading in chunks gives the same data as reading in one chunk
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from cvr_analysis_1 import CvrBusiness
+
+
+@pytest.fixture
+def mixed_db(cvr_db):
+    # industry_code without a column type, holding numbers and text like
+    # cvr.db, with only numbers in the first chunks
+    conn = sqlite3.connect(cvr_db)
+    conn.executescript('''
+        ALTER TABLE company RENAME TO typed_company;
+        CREATE TABLE company(cvr_number, industry_code, name, description);
+        INSERT INTO company SELECT cvr_number,
+            CASE WHEN rowid > 100 AND rowid % 3 = 0 THEN industry_code || 'a'
+                 ELSE CAST(industry_code AS INTEGER) END,
+            name, description FROM typed_company;
+        DROP TABLE typed_company;
+    ''')
+    conn.close()
+    yield cvr_db
+    CvrBusiness.invalidate_cache()
+
+
+def test_mixed_column_in_chunks():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE company(cvr_number, industry_code)')
+    conn.executemany('INSERT INTO company VALUES (?, ?)',
+                     [(i, i % 5 if i < 10 or i % 2 else f'{i % 5}a') for i in range(30)])
+    query = 'SELECT * FROM company'
+
+    in_one = CvrBusiness(chunksize=100)._read_chunks(conn, query)
+    in_chunks = CvrBusiness(chunksize=10)._read_chunks(conn, query)
+    pd.testing.assert_frame_equal(in_chunks, in_one)
+    assert in_chunks['industry_code'].tolist()[:11] == ['0', '1', '2', '3', '4'] * 2 + ['0a']
+
+
+@pytest.mark.parametrize('sql_join', [False, True])
+def test_merge_in_chunks(mixed_db, tmp_path, sql_join):
+    def merged(chunksize):
+        cv = CvrBusiness(mixed_db, cache_dir=str(tmp_path / f'cache{chunksize}'),
+                         sql_join=sql_join, chunksize=chunksize)
+        return cv.load_snapshot('dashboard')
+
+    pd.testing.assert_frame_equal(merged(10), merged(100000))
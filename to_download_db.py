@@ -1,6 +1,22 @@
+import argparse
+import os
+
 from cvr_analysis_1 import CvrBusiness
 
+parser = argparse.ArgumentParser(description='Download the CVR database and build its snapshot')
+parser.add_argument('--delta', help='delta file (sqlite or csv of financials) to apply instead of a full rebuild')
+args = parser.parse_args()
+
 cv = CvrBusiness()
 
 # saving db
-cv.check_file_exists()
\ No newline at end of file
+cv.check_file_exists()
+
+if args.delta:
+    # applying new filings, only the changed companies are re-read
+    changed = cv.apply_delta(args.delta)
+    print(f'Updated {len(changed)} companies')
+
+# building snapshot of merged tables, a patched snapshot is kept
+if not args.delta or not os.path.exists(cv.snapshot_path(profile='dashboard')):
+    cv.build_snapshot(profile='dashboard')
@@ -0,0 +1,24 @@
+# Builds the snapshot, KPI tables and clusterings before the app gets traffic
+import argparse
+import time
+from cvr_analysis_1 import CvrBusiness, cluster_features
+
+parser = argparse.ArgumentParser(description='Prepare the data used by the app')
+parser.add_argument('--db', default='cvr.db', help='path to cvr database')
+parser.add_argument('--profile', default='dashboard', help='column profile of the snapshot')
+parser.add_argument('--clusters', type=int, default=10)
+parser.add_argument('--best-k', action='store_true',
+                    help='also score the numbers of clusters used by "Use Best No of Clusters"')
+args = parser.parse_args()
+
+start = time.perf_counter()
+cv = CvrBusiness(args.db)
+data = cv.warmup(profile=args.profile, num_clusters=args.clusters)
+if args.best_k:
+    for metric in ['profit_loss', cluster_features]:
+        cv.best_k(metric)
+
+print(f'Prepared {len(data)} rows in {time.perf_counter() - start:.1f}s')
+report = data.attrs['memory_report']
+print(f"Merged data uses {report['after_mb']} MB, {report['saved_mb']} MB less than "
+      f"before its types were compacted ({report['before_mb']} MB)")